@@ -0,0 +1,192 @@
+'''
+artifactstore.py: content-addressed local store for downloaded artifacts
+
+Every file fetched through ArtifactStore.fetch() is kept once, as a
+blob named by its sha256 under <root>/sha256/, with hard links under
+<root>/md5/ and <root>/sha512/ so it can be found by whichever checksum
+a server publishes.  The requested destination is then a hard link to
+the blob (or a symlink, if the destination is on another filesystem),
+so the same package fetched for two branches or two runs is stored,
+and if we know its checksum or url, downloaded, only once.
+
+If the caller knows the server-side checksum of a file, fetch() won't
+download it at all if we already have that blob, and will refuse a
+download that doesn't match.  Without one, a url we've fetched before
+is looked up in <root>/urls/.
+
+Destinations are links into the store: don't modify them in place.
+
+The store lives at $ARTIFACT_STORE, or DEFAULT_PATH if that's not set;
+set ARTIFACT_STORE to 'none' (or empty) to disable it.
+'''
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+import download
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PATH = '~/.cache/artifact-store'
+# blobs are named by the first, and linked under the others
+ALGORITHMS = ('sha256', 'md5', 'sha512')
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _link(src, dst):
+    '''
+    os.link(), but dst already existing is fine: another thread (or
+    process) storing the same content got there first
+    '''
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _url_key(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+def file_digests(path):
+    ''' Return {algo: hexdigest} of the file at path for each of ALGORITHMS '''
+    hashes = dict((algo, hashlib.new(algo)) for algo in ALGORITHMS)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            for h in hashes.values():
+                h.update(chunk)
+    return dict((algo, h.hexdigest()) for algo, h in hashes.items())
+
+
+class ArtifactStore(object):
+
+    def __init__(self, root=DEFAULT_PATH):
+        self.root = os.path.expanduser(root)
+        for subdir in ALGORITHMS + ('urls', 'tmp'):
+            _makedirs(os.path.join(self.root, subdir))
+
+    def _blob_path(self, algo, digest):
+        digest = digest.lower()
+        return os.path.join(self.root, algo, digest[:2], digest)
+
+    def find(self, algo, digest):
+        ''' Return the path of the blob with this checksum, or None '''
+        path = self._blob_path(algo, digest)
+        return path if os.path.exists(path) else None
+
+    def find_url(self, url):
+        ''' Return the path of the blob last fetched from url, or None '''
+        try:
+            with open(os.path.join(self.root, 'urls', _url_key(url))) as f:
+                return self.find(ALGORITHMS[0], f.read().strip())
+        except IOError:
+            return None
+
+    def add(self, path, url=None, checksum=None):
+        '''
+        Move the file at path into the store and return its blob path.
+        If checksum (algo, hexdigest) is given and doesn't match, remove
+        the file and raise IOError.  If url is given, remember it.
+        '''
+        digests = file_digests(path)
+        if checksum is not None:
+            algo, expected = checksum
+            if digests[algo] != expected.lower():
+                os.remove(path)
+                raise IOError('{0}: {1} {2} does not match expected {3}'.format(
+                    url or path, algo, digests[algo], expected))
+        blob = self._blob_path(ALGORITHMS[0], digests[ALGORITHMS[0]])
+        _makedirs(os.path.dirname(blob))
+        # link rather than rename, so if the same content is being
+        # stored concurrently the first one wins and the rest just go
+        _link(path, blob)
+        os.remove(path)
+        for algo in ALGORITHMS[1:]:
+            alias = self._blob_path(algo, digests[algo])
+            _makedirs(os.path.dirname(alias))
+            _link(blob, alias)
+        if url is not None:
+            urlpath = os.path.join(self.root, 'urls', _url_key(url))
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(urlpath))
+            with os.fdopen(fd, 'w') as f:
+                f.write(digests[ALGORITHMS[0]])
+            os.rename(tmp, urlpath)
+        return blob
+
+    def link(self, blob, dest):
+        ''' Make dest a hard link (or failing that, a symlink) to blob '''
+        # a private directory next to dest, so concurrent link()s to the
+        # same dest can't trip over each other's temporary links
+        tmpdir = tempfile.mkdtemp(prefix='.link', dir=os.path.dirname(dest) or '.')
+        tmp = os.path.join(tmpdir, 'link')
+        try:
+            try:
+                os.link(blob, tmp)
+            except OSError:
+                os.symlink(blob, tmp)
+            os.rename(tmp, dest)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _find(self, url, checksum=None):
+        if checksum is not None:
+            return self.find(*checksum)
+        return self.find_url(url)
+
+    def fetch(self, session, url, dest, checksum=None, **kwargs):
+        '''
+        Make dest a link to the content of url, downloading it only if
+        it isn't already in the store.  checksum, if known, is
+        (algo, hexdigest) with algo one of ALGORITHMS.  kwargs are
+        passed to download.download().  Return the number of bytes
+        transferred.
+        '''
+        blob = self._find(url, checksum)
+        if blob is not None:
+            log.debug('%s: already in store as %s', url, blob)
+            self.link(blob, dest)
+            return 0
+        # download into the store, so a partial download can be
+        # resumed however it's asked for next time.  Only one fetch of
+        # a url (in any thread or process) downloads it at a time; the
+        # others wait for it and then find it in the store.
+        tmp = os.path.join(self.root, 'tmp', _url_key(url))
+        transferred = 0
+        with open(tmp + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            blob = self._find(url, checksum)
+            if blob is None:
+                transferred = download.download(session, url, tmp, **kwargs)
+                blob = self.add(tmp, url=url, checksum=checksum)
+        self.link(blob, dest)
+        return transferred
+
+
+_default_store = None
+
+
+def default_store():
+    '''
+    Return the process-wide ArtifactStore named by $ARTIFACT_STORE
+    (or DEFAULT_PATH), or None if the store has been turned off
+    '''
+    global _default_store
+    path = os.environ.get('ARTIFACT_STORE', DEFAULT_PATH)
+    if not path or path.lower() == 'none':
+        return None
+    if _default_store is None:
+        _default_store = ArtifactStore(path)
+    return _default_store
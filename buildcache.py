@@ -0,0 +1,179 @@
+'''
+buildcache.py: persistent local cache of finished Jenkins build metadata
+
+A finished Jenkins build never changes, so once we've seen its metadata
+there's no reason to ask the server again.  BuildCache keeps build
+documents in a small SQLite database keyed by (server, job, buildnum,
+variant); 'variant' lets different tools store different views of the
+same build (the full api/json, a summary, the injected env vars, ...)
+without stepping on each other.
+
+Only finished builds are stored: anything whose 'building' key is true
+is silently ignored by put() and put_many(), so in-progress builds are
+always refetched.
+
+Entries older than max_age seconds are dropped, and if there are more
+than max_entries the least-recently-used ones go, each time the cache
+is opened.  Hits only note their use time in memory; it's written
+out with the next put(), evict() or close(), so reading from a warm
+cache doesn't cost a disk sync per build.
+
+The cache lives at $JENKINS_BUILD_CACHE, or DEFAULT_PATH if that's
+not set; set JENKINS_BUILD_CACHE to 'none' (or empty) to disable it.
+'''
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PATH = '~/.cache/jenkins-builds.sqlite'
+# a month
+MAX_AGE = 30 * 24 * 60 * 60
+MAX_ENTRIES = 200000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS builds (
+    server TEXT NOT NULL,
+    job TEXT NOT NULL,
+    buildnum INTEGER NOT NULL,
+    variant TEXT NOT NULL,
+    stored REAL NOT NULL,
+    used REAL NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (server, job, buildnum, variant)
+);
+CREATE INDEX IF NOT EXISTS builds_used ON builds (used);
+'''
+
+
+class BuildCache(object):
+    '''
+    SQLite-backed cache of finished build metadata.  Safe to share
+    between threads.
+    '''
+
+    def __init__(self, path=DEFAULT_PATH, max_age=MAX_AGE,
+                 max_entries=MAX_ENTRIES):
+        self.path = os.path.expanduser(path)
+        self.max_age = max_age
+        self.max_entries = max_entries
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._lock = threading.Lock()
+        # (server, job, buildnum, variant): time of last get() hit
+        self._used = dict()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock:
+            self._db.executescript(SCHEMA)
+        self.evict()
+
+    def get(self, server, job, buildnum, variant=''):
+        '''
+        Return the cached document for a build, or None if we don't have it
+        '''
+        key = (server, job, int(buildnum), variant)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT data FROM builds WHERE server=? AND job=? '
+                'AND buildnum=? AND variant=?',
+                key,
+            ).fetchone()
+            if row is None:
+                return None
+            self._used[key] = time.time()
+        return json.loads(row[0])
+
+    def _write_used(self):
+        ''' With the lock held, record the hits since last time (no commit) '''
+        if self._used:
+            self._db.executemany(
+                'UPDATE builds SET used=? WHERE server=? AND job=? '
+                'AND buildnum=? AND variant=?',
+                [(used,) + key for key, used in self._used.items()],
+            )
+            self._used.clear()
+
+    def put(self, server, job, buildnum, data, variant=''):
+        '''
+        Store data for a build, unless it says it's still building
+        '''
+        if data.get('building'):
+            return
+        now = time.time()
+        with self._lock:
+            self._write_used()
+            self._db.execute(
+                'INSERT OR REPLACE INTO builds VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (server, job, int(buildnum), variant, now, now,
+                 json.dumps(data)),
+            )
+            self._db.commit()
+
+    def put_many(self, server, job, builds, variant=''):
+        '''
+        Store data for each (buildnum, data) in builds that isn't
+        still building and isn't already cached, with one commit
+        '''
+        now = time.time()
+        rows = [(server, job, int(buildnum), variant, now, now,
+                 json.dumps(data))
+                for buildnum, data in builds if not data.get('building')]
+        with self._lock:
+            self._write_used()
+            # a finished build never changes, so what's there is current
+            self._db.executemany(
+                'INSERT OR IGNORE INTO builds VALUES (?, ?, ?, ?, ?, ?, ?)',
+                rows,
+            )
+            self._db.commit()
+
+    def evict(self):
+        ''' Drop expired entries, then least-recently-used ones over the limit '''
+        with self._lock:
+            self._write_used()
+            cur = self._db.execute(
+                'DELETE FROM builds WHERE stored < ?',
+                (time.time() - self.max_age,),
+            )
+            expired = cur.rowcount
+            cur = self._db.execute(
+                'DELETE FROM builds WHERE rowid IN '
+                '(SELECT rowid FROM builds ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,),
+            )
+            self._db.commit()
+        log.debug('buildcache: evicted %d expired, %d over limit',
+                  expired, cur.rowcount)
+
+    def close(self):
+        with self._lock:
+            if self._db is None:
+                return
+            self._write_used()
+            self._db.commit()
+            self._db.close()
+            self._db = None
+
+
+_default_cache = None
+
+
+def default_cache():
+    '''
+    Return the process-wide BuildCache named by $JENKINS_BUILD_CACHE
+    (or DEFAULT_PATH), or None if caching has been turned off
+    '''
+    global _default_cache
+    path = os.environ.get('JENKINS_BUILD_CACHE', DEFAULT_PATH)
+    if not path or path.lower() == 'none':
+        return None
+    if _default_cache is None:
+        _default_cache = BuildCache(path)
+        atexit.register(_default_cache.close)
+    return _default_cache
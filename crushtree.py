@@ -0,0 +1,76 @@
+'''
+crushtree.py: the crush hierarchy from 'ceph osd tree -f json'
+
+'ceph osd tree -f json' gives a flat list of crush nodes: each has an
+'id' (negative for buckets, the osd number for osds), a 'name', a
+'type' ('root', 'row', 'rack', 'host', 'osd', or whatever the map
+defines) and, for buckets, the ids of its 'children'.
+
+CrushTree indexes that list once, by id and by parent, so looking
+a node up is a dict hit and walking a subtree is linear in its size,
+for any depth or shape of hierarchy and whatever order the nodes come
+in.  host_to_osds() gives the {host: [osd names]} map osd_daemon_cmd
+and ssh.py work from.
+'''
+
+
+class CrushTree(object):
+
+    def __init__(self, nodes):
+        # id: node
+        self.nodes = dict()
+        # id: id of the bucket it's in
+        self.parents = dict()
+        for node in nodes:
+            self.nodes[node['id']] = node
+        for node in nodes:
+            for child in node.get('children', ()):
+                self.parents[child] = node['id']
+
+    def name(self, id):
+        ''' Name of node id; osds missing from the list are 'osd.<id>' '''
+        node = self.nodes.get(id)
+        if node is not None:
+            return node['name']
+        return 'osd.%d' % id if id >= 0 else str(id)
+
+    def of_type(self, type):
+        ''' Return the nodes of crush type 'type' '''
+        return [node for node in self.nodes.values() if node['type'] == type]
+
+    def descendants(self, id, type=None):
+        '''
+        Return the ids of everything under node id (of crush type
+        'type', if given), depth first in 'children' order.  Osds are
+        non-negative ids even if the list didn't include them.
+        '''
+        found = list()
+        stack = list(reversed(self.nodes[id].get('children', ())))
+        while stack:
+            child = stack.pop()
+            node = self.nodes.get(child)
+            if node is None:
+                if type is None or (type == 'osd' and child >= 0):
+                    found.append(child)
+                continue
+            if type is None or node['type'] == type:
+                found.append(child)
+            stack.extend(reversed(node.get('children', ())))
+        return found
+
+    def ancestor(self, id, type):
+        ''' Return the id of the nearest bucket of 'type' above id, or None '''
+        parent = self.parents.get(id)
+        while parent is not None:
+            if self.nodes[parent]['type'] == type:
+                return parent
+            parent = self.parents.get(parent)
+        return None
+
+    def host_to_osds(self):
+        ''' Return a dict of osds[host] = [osd.n, osd.m, ..] '''
+        return dict(
+            (host['name'],
+             [self.name(id) for id in self.descendants(host['id'], 'osd')])
+            for host in self.of_type('host')
+        )
@@ -0,0 +1,260 @@
+'''
+download.py: resumable, concurrent HTTP file downloads
+
+download() fetches one url to a local file.  It skips the transfer if
+the file is already there with the size the server reports, writes
+into '<dest>.part' and renames into place only when complete, and
+resumes an existing '.part' file with an HTTP Range request.  Big
+files can be fetched as several concurrent ranges, and progress shown
+as a rate-limited one-line report.
+
+download_all() runs download() over a list of (url, dest) pairs with
+a bounded thread pool sharing one keep-alive session, logging
+per-file and overall throughput; give it ArtifactStore.fetch (see
+artifactstore.py) to go through the local artifact store instead.
+'''
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+
+import requests
+
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+CONCURRENCY = 4
+# don't bother splitting anything smaller than this into segments
+SEGMENT_MIN_SIZE = 64 * 1024 * 1024
+MB = 1024.0 * 1024.0
+
+
+def make_session(concurrency=CONCURRENCY):
+    '''
+    Return a requests.Session with a connection pool big enough for
+    'concurrency' threads
+    '''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=concurrency,
+        pool_maxsize=concurrency,
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class Progress(object):
+    '''
+    One-line progress report on stderr, redrawn at most every INTERVAL
+    seconds: MB so far, percentage if the total is known, and MB/s.
+    Safe to update from several threads.
+    '''
+
+    INTERVAL = 0.5
+
+    def __init__(self, name, total=None, stream=sys.stderr):
+        self.name = name
+        self.total = total
+        self.stream = stream
+        self.have = 0
+        self.transferred = 0
+        self.start = time.time()
+        self.last = 0
+        self._lock = threading.Lock()
+
+    def update(self, nbytes, transferred=True):
+        '''
+        Count nbytes more of the file; transferred=False for bytes that
+        were already there (resumed downloads), so they don't count
+        towards the rate
+        '''
+        with self._lock:
+            self.have += nbytes
+            if transferred:
+                self.transferred += nbytes
+            now = time.time()
+            if now - self.last >= self.INTERVAL:
+                self.last = now
+                self._show(now)
+
+    def _show(self, now):
+        line = '%s: %.1f MB' % (self.name, self.have / MB)
+        if self.total:
+            line += ' of %.1f MB (%d%%)' % (self.total / MB,
+                                            100 * self.have // self.total)
+        line += ', %.1f MB/s' % (
+            self.transferred / MB / max(now - self.start, 0.001))
+        self.stream.write('\r' + line + '  ')
+        self.stream.flush()
+
+    def finish(self):
+        with self._lock:
+            self._show(time.time())
+            self.stream.write('\n')
+
+
+def remote_info(session, url):
+    '''
+    Return (Content-Length or None if the server won't say,
+    whether the server accepts byte Range requests) for url
+    '''
+    resp = session.head(url, allow_redirects=True)
+    resp.raise_for_status()
+    size = resp.headers.get('Content-Length')
+    ranges = resp.headers.get('Accept-Ranges', '').lower() == 'bytes'
+    return (int(size) if size is not None else None), ranges
+
+
+def _fetch_range(session, url, part, start=0, end=None,
+                 chunk_size=CHUNK_SIZE, progress=None):
+    '''
+    Fetch bytes start through end (inclusive; None means to the end)
+    of url into the file part, resuming from whatever part already
+    holds.  Return the number of bytes transferred.
+    '''
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    length = None if end is None else end - start + 1
+    if length is not None and offset > length:
+        offset = 0
+    if progress and offset:
+        progress.update(offset, transferred=False)
+    if offset == length:
+        return 0
+
+    headers = dict()
+    if start + offset or end is not None:
+        headers['Range'] = 'bytes=%d-%s' % (
+            start + offset, '' if end is None else end)
+    resp = session.get(url, headers=headers, stream=True, allow_redirects=True)
+    if resp.status_code == 416 and start == 0 and end is None:
+        # our partial file is no use to the server; start over
+        offset = 0
+        resp = session.get(url, stream=True, allow_redirects=True)
+    resp.raise_for_status()
+    if headers and resp.status_code != 206:
+        if start or end is not None:
+            raise IOError('{0}: server ignored Range request'.format(url))
+        log.debug('%s: server ignored Range, restarting', url)
+        offset = 0
+    if offset:
+        log.debug('%s: resuming at %d', part, offset)
+
+    transferred = 0
+    with open(part, 'ab' if offset else 'wb') as f:
+        for chunk in resp.iter_content(chunk_size):
+            f.write(chunk)
+            transferred += len(chunk)
+            if progress:
+                progress.update(len(chunk))
+    return transferred
+
+
+def _fetch_segments(session, url, part, size, segments, chunk_size, progress):
+    '''
+    Fetch url (of known size) as 'segments' concurrent ranged requests,
+    each into its own resumable file, and join them into part.  Return
+    the number of bytes transferred.
+    '''
+    step = -(-size // segments)
+    ranges = [(start, min(start + step, size) - 1)
+              for start in range(0, size, step)]
+    # name segment files by their range, so a retry with a different
+    # segment count doesn't resume from the wrong offsets
+    segpaths = ['%s.%d-%d' % (part, start, end) for start, end in ranges]
+
+    def _fetch(i):
+        start, end = ranges[i]
+        return _fetch_range(session, url, segpaths[i], start, end,
+                            chunk_size, progress)
+
+    pool = ThreadPool(len(ranges))
+    try:
+        transferred = sum(pool.map(_fetch, range(len(ranges))))
+    finally:
+        pool.close()
+        pool.join()
+    with open(part, 'wb') as out:
+        for segpath in segpaths:
+            with open(segpath, 'rb') as f:
+                shutil.copyfileobj(f, out, chunk_size)
+    for segpath in segpaths:
+        os.remove(segpath)
+    return transferred
+
+
+def download(session, url, dest, chunk_size=CHUNK_SIZE, segments=1,
+             progress=False):
+    '''
+    Fetch url to the file dest, skipping it if it's already present
+    with the right size and resuming a previous partial download.
+    If segments > 1 and the server allows it, files of at least
+    SEGMENT_MIN_SIZE are fetched as that many concurrent ranges.
+    If progress, show a Progress line on stderr.
+    Return the number of bytes transferred.
+    '''
+    size, ranges = remote_info(session, url)
+    if size is not None and os.path.exists(dest) and \
+            os.path.getsize(dest) == size:
+        log.debug('%s: already present, skipping', dest)
+        return 0
+
+    part = dest + '.part'
+    bar = Progress(os.path.basename(dest), size) if progress else None
+    if size is not None and os.path.exists(part) and \
+            os.path.getsize(part) == size:
+        # finished last time, but never renamed
+        transferred = 0
+    elif segments > 1 and ranges and size and size >= SEGMENT_MIN_SIZE:
+        transferred = _fetch_segments(session, url, part, size, segments,
+                                      chunk_size, bar)
+    else:
+        transferred = _fetch_range(session, url, part,
+                                   chunk_size=chunk_size, progress=bar)
+    if bar:
+        bar.finish()
+    if size is not None and os.path.getsize(part) != size:
+        raise IOError('{0}: got {1} of {2} bytes'.format(
+            url, os.path.getsize(part), size))
+    os.rename(part, dest)
+    return transferred
+
+
+def download_all(session, downloads, concurrency=CONCURRENCY, fetch=None):
+    '''
+    fetch(session, url, dest) (by default, download()) each (url, dest)
+    in 'downloads', 'concurrency' at a time.  Return the total number
+    of bytes transferred.
+    '''
+    if fetch is None:
+        fetch = download
+
+    def _download(urldest):
+        url, dest = urldest
+        start = time.time()
+        transferred = fetch(session, url, dest)
+        return dest, transferred, time.time() - start
+
+    downloads = list(downloads)
+    start = time.time()
+    total = 0
+    pool = ThreadPool(concurrency)
+    try:
+        for done, (dest, transferred, elapsed) in enumerate(
+                pool.imap_unordered(_download, downloads), 1):
+            total += transferred
+            log.info('%d/%d %s: %.1f MB in %.1fs (%.1f MB/s)',
+                     done, len(downloads), os.path.basename(dest),
+                     transferred / MB, elapsed,
+                     transferred / MB / max(elapsed, 0.001))
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+    log.info('fetched %.1f MB in %.1fs (%.1f MB/s)',
+             total / MB, elapsed, total / MB / max(elapsed, 0.001))
+    return total
@@ -1,45 +1,263 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
+import json
+import logging
+import os
 import requests
+import shutil
 from string import Template
 import sys
+import threading
+import time
 import urllib.parse
 
+import artifactstore
+import download
+
 
 SHAMAN_SEARCH = 'https://shaman.ceph.com/api/search/?distros=$distro/$distrover&sha1=$sha1'
-CHACRA_BIN='https://$chacra_host/binaries/ceph/$ref/$sha1/$distro/$distrover/x86_64/flavors/default/$filename/'
+CHACRA_DIR='https://$chacra_host/binaries/ceph/$ref/$sha1/$distro/$distrover/x86_64/flavors/default/'
+CHACRA_BIN=CHACRA_DIR + '$filename/'
 
 SHA1='0630b7c1b61cccc21285a267ae785a0fa7a04a47'
 DISTRO='windows'
 DISTROVER='1809'
 FILENAME='ceph.zip'
 
+SHAMAN_CACHE='~/.cache/getbin-shaman.json'
+# how long to believe shaman when it says there's no build yet
+NEGATIVE_TTL=10 * 60
+
+
+def chacra_checksum(session, dir_url, filename):
+    '''
+    Return the ('sha512', checksum) chacra recorded for filename in
+    its listing of dir_url, or None if it doesn't have one
+    '''
+    try:
+        resp = session.get(dir_url)
+        resp.raise_for_status()
+        info = resp.json().get(filename)
+    except (requests.RequestException, ValueError, AttributeError):
+        return None
+    if isinstance(info, dict) and info.get('checksum'):
+        return ('sha512', info['checksum'])
+    return None
+
 
-def getbin(sha1, distro, distrover, filename):
-    resp = requests.get(Template(SHAMAN_SEARCH).substitute(
+def shaman_search(session, sha1, distro, distrover):
+    '''
+    Ask shaman where the build of sha1 for distro/distrover is;
+    return (chacra_host, ref)
+    '''
+    resp = session.get(Template(SHAMAN_SEARCH).substitute(
         distro=distro,
         distrover=distrover,
         sha1=sha1,
-        filename=filename,
     ))
     resp.raise_for_status()
+    if not resp.json():
+        raise LookupError(f'no build of {sha1} for {distro}/{distrover} on shaman')
     chacra_host = urllib.parse.urlparse(resp.json()[0]['url']).netloc
     ref = resp.json()[0]['ref']
     print(f'got chacra host {chacra_host}, ref {ref} from {resp.url}')
-    resp = requests.get(Template(CHACRA_BIN).substitute(
+    return chacra_host, ref
+
+
+class ShamanCache:
+    '''
+    Remember shaman_search() results in a JSON file.  Where a build of
+    sha1/distro/distrover lives never changes once it exists, so those
+    are kept forever; "no build yet" is only believed for NEGATIVE_TTL
+    seconds.  With refresh, cached answers are ignored (but new ones
+    are still saved).
+    '''
+
+    def __init__(self, path=SHAMAN_CACHE, refresh=False):
+        self.path = os.path.expanduser(path)
+        self.refresh = refresh
+        self.entries = dict()
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def search(self, session, sha1, distro, distrover):
+        ''' shaman_search(), answered from the cache if possible '''
+        key = f'{sha1}/{distro}/{distrover}'
+        with self._lock:
+            entry = self.entries.get(key)
+        if entry and not self.refresh:
+            if 'chacra_host' in entry:
+                return entry['chacra_host'], entry['ref']
+            if time.time() - entry['time'] < NEGATIVE_TTL:
+                raise LookupError(f'no build of {sha1} for {distro}/{distrover} '
+                                  f'on shaman (cached)')
+        try:
+            chacra_host, ref = shaman_search(session, sha1, distro, distrover)
+        except LookupError:
+            with self._lock:
+                self.entries[key] = dict(time=time.time())
+            raise
+        with self._lock:
+            self.entries[key] = dict(chacra_host=chacra_host, ref=ref, time=time.time())
+        return chacra_host, ref
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(self.entries, f)
+            os.rename(self.path + '.tmp', self.path)
+
+
+def chacra_urls(chacra_host, ref, sha1, distro, distrover, filename):
+    ''' Return (url of the chacra binary directory, url of filename) '''
+    subs = dict(
         chacra_host=chacra_host,
         ref=ref,
         sha1=sha1,
         distro=distro,
         distrover=distrover,
         filename=filename,
-    ), stream=True)
-    resp.raise_for_status()
-    print(f'got file from {resp.url}')
-    with open(filename, 'wb') as f:
-        for chunk in resp.iter_content(chunk_size=None, decode_unicode=True):
-            print('.',)
-            f.write(chunk)
+    )
+    return Template(CHACRA_DIR).substitute(subs), Template(CHACRA_BIN).substitute(subs)
+
+
+def fetch(session, dir_url, url, filename, dest, **kwargs):
+    '''
+    Fetch url (the chacra binary filename in dir_url) to dest, through
+    the artifact store if there is one.  kwargs go to download.download().
+    Return the number of bytes transferred.
+    '''
+    store = artifactstore.default_store()
+    if store is None:
+        return download.download(session, url, dest, **kwargs)
+    checksum = chacra_checksum(session, dir_url, filename)
+    return store.fetch(session, url, dest, checksum=checksum, **kwargs)
+
+
+def search(session, cache, sha1, distro, distrover):
+    ''' shaman_search() through cache, a ShamanCache, if it's not None '''
+    if cache is None:
+        return shaman_search(session, sha1, distro, distrover)
+    return cache.search(session, sha1, distro, distrover)
+
+
+def getbin(sha1, distro, distrover, filename, segments=1, progress=True,
+           cache=None):
+    session = download.make_session(segments)
+    try:
+        chacra_host, ref = search(session, cache, sha1, distro, distrover)
+    finally:
+        if cache is not None:
+            cache.save()
+    dir_url, url = chacra_urls(chacra_host, ref, sha1, distro, distrover, filename)
+    transferred = fetch(session, dir_url, url, filename, filename,
+                        segments=segments, progress=progress)
+    print(f'got file from {url} ({transferred} bytes transferred)')
+
+
+def read_manifest(f, outdir):
+    '''
+    Read a batch manifest: one 'sha1 distro distrover filename [dest]'
+    per line; blank lines and #comments are ignored.  dest defaults to
+    outdir/sha1/distro-distrover/filename.  Return a list of
+    (sha1, distro, distrover, filename, dest).
+    '''
+    entries = list()
+    for line in f:
+        line = line.split('#', 1)[0].split()
+        if not line:
+            continue
+        if len(line) not in (4, 5):
+            raise ValueError(f'bad manifest line: {" ".join(line)}')
+        sha1, distro, distrover, filename = line[:4]
+        if len(line) == 5:
+            dest = line[4]
+        else:
+            dest = os.path.join(outdir, sha1, f'{distro}-{distrover}', filename)
+        entries.append((sha1, distro, distrover, filename, dest))
+    return entries
+
+
+def getbins(entries, concurrency=download.CONCURRENCY, cache=None):
+    '''
+    Fetch every (sha1, distro, distrover, filename, dest) in entries:
+    search shaman once per distinct sha1/distro/distrover, all searches
+    concurrently, then download everything, at most 'concurrency'
+    requests at a time throughout, over one pooled session.  Searches
+    go through cache, a ShamanCache, if it's not None.  An entry that
+    can't be found or fetched doesn't stop the others; return a list
+    of (entry, error) for those that failed.
+    '''
+    session = download.make_session(concurrency)
+    searches = sorted(set((sha1, distro, distrover)
+                          for sha1, distro, distrover, _, _ in entries))
+
+    def _search(s):
+        try:
+            return search(session, cache, *s)
+        except (LookupError, requests.RequestException) as e:
+            return e
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            found = dict(zip(searches, executor.map(_search, searches)))
+    finally:
+        if cache is not None:
+            cache.save()
+
+    failed = list()
+    # url: entries waiting on it
+    entries_of = dict()
+    downloads = list()
+    # url: (dir_url, filename, first dest)
+    urls = dict()
+    # (url, dest) of urls that are already being downloaded to another dest
+    duplicates = list()
+    for entry in entries:
+        sha1, distro, distrover, filename, dest = entry
+        result = found[(sha1, distro, distrover)]
+        if isinstance(result, Exception):
+            failed.append((entry, result))
+            continue
+        chacra_host, ref = result
+        dir_url, url = chacra_urls(chacra_host, ref, sha1, distro, distrover, filename)
+        os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+        entries_of.setdefault(url, []).append(entry)
+        if url in urls:
+            duplicates.append((url, dest))
+            continue
+        urls[url] = (dir_url, filename, dest)
+        downloads.append((url, dest))
+
+    # url: why it couldn't be fetched
+    errors = dict()
+
+    def _fetch(session, url, dest):
+        dir_url, filename, _ = urls[url]
+        try:
+            return fetch(session, dir_url, url, filename, dest)
+        except (IOError, requests.RequestException) as e:
+            errors[url] = e
+            return 0
+
+    download.download_all(session, downloads, concurrency, fetch=_fetch)
+    store = artifactstore.default_store()
+    for url, dest in duplicates:
+        first = urls[url][2]
+        if url in errors or os.path.abspath(dest) == os.path.abspath(first):
+            continue
+        if store is not None:
+            # first is a link into the store; make dest another one
+            store.link(os.path.realpath(first), dest)
+        else:
+            shutil.copyfile(first, dest)
+    for url, e in errors.items():
+        failed.extend((entry, e) for entry in entries_of[url])
+    return failed
 
 
 def main():
@@ -48,9 +266,34 @@ def main():
     parser.add_argument('--distro', '-D', default=DISTRO)
     parser.add_argument('--distrover', '-V', default=DISTROVER)
     parser.add_argument('--filename', '-f', default=FILENAME)
+    parser.add_argument('--segments', '-S', type=int, default=1,
+                        help='fetch large files as this many concurrent ranges')
+    parser.add_argument('--quiet', '-q', action='store_true',
+                        help="don't show download progress")
+    parser.add_argument('--manifest', '-m', type=argparse.FileType('r'),
+                        help="fetch every 'sha1 distro distrover filename [dest]' "
+                        "line of this file ('-' for stdin) instead")
+    parser.add_argument('--outdir', '-o', default='.',
+                        help='with --manifest, default dest is OUTDIR/sha1/distro-distrover/filename')
+    parser.add_argument('--concurrency', '-c', type=int, default=download.CONCURRENCY,
+                        help='with --manifest, max requests at once')
+    parser.add_argument('--no-cache', action='store_true',
+                        help="don't use or update the shaman search cache")
+    parser.add_argument('--refresh', action='store_true',
+                        help='ignore cached shaman searches (but save the new results)')
     args=parser.parse_args()
 
-    getbin(args.sha1, args.distro, args.distrover, args.filename)
+    cache = None if args.no_cache else ShamanCache(refresh=args.refresh)
+    if args.manifest:
+        logging.basicConfig(level=logging.INFO)
+        failed = getbins(read_manifest(args.manifest, args.outdir),
+                         args.concurrency, cache=cache)
+        for (sha1, distro, distrover, filename, dest), e in failed:
+            print(f'{sha1} {distro} {distrover} {filename}: {e}', file=sys.stderr)
+        return 1 if failed else 0
+
+    getbin(args.sha1, args.distro, args.distrover, args.filename,
+           segments=args.segments, progress=not args.quiet, cache=cache)
     return 0
 
 
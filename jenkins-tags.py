@@ -1,13 +1,24 @@
 #!/usr/bin/python3
 
 import argparse
+import json
 import os
+import shlex
 import sys
 import re
 import requests
+import time
 
+from collections import defaultdict
 
-def parse_args():
+# only what we look at, for every node
+INVENTORY_TREE = 'computer[displayName,offline,assignedLabels[name],_class]'
+INVENTORY_CACHE = '~/.cache/jenkins-tags-{host}.json'
+# seconds an inventory snapshot is good for
+MAX_AGE = 60
+
+
+def parse_args(argv=None):
     ap = argparse.ArgumentParser()
     ap.add_argument('-l', '--list', action='store_true', help="Output comma-separated list of nodes")
     ap.add_argument('-o', '--offline', action='store_true', help="Print offline hosts as well (marked OFFLINE)")
@@ -17,36 +28,72 @@ def parse_args():
     ap.add_argument('-n', '--negative', action='store_true', help="negate -t or -T (none of these tags present or these specific tags not present together")
     ap.add_argument('-d', '--delimiter', help="char to separate tags in output", default=',')
     ap.add_argument('-g', '--group', action="store_true", help="format for jenkins group vars")
+    ap.add_argument('-a', '--max-age', type=int, default=MAX_AGE, help=f"reuse a node inventory snapshot up to this many seconds old (0 to always fetch) [{MAX_AGE}]")
+    ap.add_argument('-b', '--batch', type=argparse.FileType('r'), help="run each line of this file ('-' for stdin) as a set of query options against one inventory snapshot")
 
-    return ap.parse_args()
+    return ap.parse_args(argv)
 
 
-def intersection(list1, list2):
-   '''
-   list1 is a list of REs; search for a full match for each RE
-   in each member of list2, and return the members that match
-   (fully)
+class TagMatcher:
+    '''
+    The -t and -T patterns, compiled once: the -t patterns as a single
+    alternation, the -T patterns each on their own
+    '''
 
-   >>> intersection(['foo', 'bar'], ['foobar', 'foobaz'])
-   []
-   >>> intersection(['foo.*', 'bar'], ['foobar', 'foobaz'])
-   ['foobar', 'foobaz']
-   >>> intersection(['.*baz', '.*bar'], ['foobar', 'foobaz'])
-   ['foobar', 'foobaz']
-   '''
-   return [l2 for l2 in list2 if [l1 for l1 in list1 if re.fullmatch(l1, l2)]] 
+    def __init__(self, anypats=None, allpats=None):
+        self.any_re = None
+        if anypats:
+            self.any_re = re.compile('|'.join(f'(?:{p})' for p in anypats))
+        self.all_res = [re.compile(p) for p in allpats or []]
 
 
-def one_for_one(list1, list2):
+class LabelIndex:
     '''
-    Does list1 of patterns match list2 in at least one match per 
-    pattern?
+    Inverted index of a node inventory: label -> set of positions in
+    'nodes'.  Patterns are matched once against the distinct labels
+    rather than against every node's labels, and queries become set
+    operations.
     '''
-    for pat in list1:
-        count = len([l2 for l2 in list2 if re.fullmatch(pat, l2)])
-        if count < 1:
-            return False
-    return True
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.labels = defaultdict(set)
+        for i, node in enumerate(nodes):
+            for d in node['assignedLabels']:
+                self.labels[d['name']].add(i)
+
+    def having(self, pattern):
+        ''' Return the nodes with a label that fully matches compiled 'pattern' '''
+        hits = set()
+        for label, nodes in self.labels.items():
+            if pattern.fullmatch(label):
+                hits |= nodes
+        return hits
+
+    def select(self, matcher, negative=False):
+        '''
+        Return the positions of the nodes with a label that fully
+        matches some -t pattern, and for each -T pattern, a label that
+        fully matches it.  With negative, neither may be true (for
+        whichever of -t and -T were given).
+
+        >>> index = LabelIndex([{'assignedLabels': [{'name': 'foobar'}, {'name': 'baz'}]},
+        ...                     {'assignedLabels': [{'name': 'bar'}]}])
+        >>> sorted(index.select(TagMatcher(['foo.*', 'bar'])))
+        [0, 1]
+        >>> sorted(index.select(TagMatcher(allpats=['foo.*', 'baz'])))
+        [0]
+        >>> sorted(index.select(TagMatcher(allpats=['foo.*', 'baz']), True))
+        [1]
+        '''
+        selected = set(range(len(self.nodes)))
+        if matcher.any_re:
+            hits = self.having(matcher.any_re)
+            selected = selected - hits if negative else selected & hits
+        if matcher.all_res:
+            hits = set.intersection(*[self.having(r) for r in matcher.all_res])
+            selected = selected - hits if negative else selected & hits
+        return selected
 
 
 def expand_csv_to_list(l):
@@ -56,15 +103,38 @@ def expand_csv_to_list(l):
     return newl
 
 
-def main():
-    host = os.environ.get('JENKINS_HOST', 'jenkins.ceph.com')
-
-    args = parse_args()
-    res = requests.get(f'https://{host}/computer/api/json')
+def fetch_nodes(host, max_age=MAX_AGE):
+    '''
+    Return the node inventory of Jenkins server 'host', from a local
+    snapshot if there's one less than max_age seconds old
+    '''
+    path = os.path.expanduser(INVENTORY_CACHE.format(host=host))
+    if max_age > 0 and os.path.exists(path) and \
+            time.time() - os.path.getmtime(path) < max_age:
+        with open(path) as f:
+            return json.load(f)
+    res = requests.get(f'https://{host}/computer/api/json', params=dict(tree=INVENTORY_TREE))
     res.raise_for_status()
     nodes = res.json()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(nodes, f)
+    os.rename(path + '.tmp', path)
+    return nodes
+
+
+def query(args, index):
+    '''
+    Return a list of {name, offline, tags} for the nodes in index
+    (a LabelIndex) that match the query in args
+    '''
+    args.tags = expand_csv_to_list(args.tags)
+    args.alltags = expand_csv_to_list(args.alltags)
+    selected = index.select(TagMatcher(args.tags, args.alltags), args.negative)
+
     hosts = []
-    for host in nodes['computer']:
+    for i in sorted(selected):
+        host = index.nodes[i]
         if host['_class'] != 'hudson.slaves.SlaveComputer':
             continue
         if not (args.offline or args.onlyoffline or args.group) and host['offline']:
@@ -72,35 +142,7 @@ def main():
         if args.onlyoffline and not host['offline']:
             continue
 
-        tags = list()
-        for d in host['assignedLabels']:
-            tags.extend([v for k,v in d.items()])
-        tags = sorted(tags)
-
-        args.tags = expand_csv_to_list(args.tags)
-        args.alltags = expand_csv_to_list(args.alltags)
-
-        if not args.negative:
-            # skip if tags don't contain any of the requested tags
-            if args.tags and not intersection(args.tags, tags):
-                continue
-
-            # skip if tags don't contain all of the requested tags
-            if args.alltags:
-                i = intersection(args.alltags, tags)
-                if not one_for_one(args.alltags, i):
-                    continue
-        else:
-            # skip if tags contain any of the requested tags
-            if args.tags and intersection(args.tags, tags):
-                continue
-
-            # skip if tags contain all of the requested tags
-            if args.alltags:
-                i = intersection(args.alltags, tags)
-                if one_for_one(args.alltags, i):
-                    continue
-
+        tags = sorted(d['name'] for d in host['assignedLabels'])
 
         name = host['displayName']
         # don't output the IP addr
@@ -108,7 +150,10 @@ def main():
             name = name[name.index('+')+1:]
 
         hosts.append({"name": name, "offline": host['offline'], "tags": tags})
+    return hosts
+
 
+def output(args, hosts):
     if args.list:
         print(args.delimiter.join([host['name'] for host in hosts]))
     elif args.group:
@@ -121,5 +166,24 @@ def main():
             print(f'{host["name"]}: {args.delimiter.join(host["tags"])} {"OFFLINE" if host["offline"] else ""}')
 
 
+def main():
+    host = os.environ.get('JENKINS_HOST', 'jenkins.ceph.com')
+
+    args = parse_args()
+    index = LabelIndex(fetch_nodes(host, args.max_age)['computer'])
+    if not args.batch:
+        output(args, query(args, index))
+        return
+
+    # one query per line, all against the same inventory
+    for line in args.batch:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        print(f'# {line}')
+        qargs = parse_args(shlex.split(line))
+        output(qargs, query(qargs, index))
+
+
 if __name__ == "__main__":
     sys.exit(main())
@@ -1,9 +1,16 @@
 #!/usr/bin/env python
+import argparse
+import json
 import logging
 import os
 import requests
 import sys
 
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
+import buildcache
+
 
 '''
 https://{server}/job/{jobname}/api/json
@@ -30,6 +37,10 @@ https://{server}/job/{jobname}/{buildnum}/api/json
 
 SERVER = 'jenkins.ceph.com'
 WHITELIST = '~/.jenkins.whitelist'
+STATEFILE = '~/.jenkins.state'
+DEFAULT_JOBS = ['ceph-pull-requests', 'ceph-pull-requests-arm64']
+# number of builds to fetch at once
+CONCURRENCY = 16
 
 JOB_TEMPLATE = 'https://{server}/job/{jobname}/api/json'
 BUILD_TEMPLATE = 'https://{server}/job/{jobname}/{buildnum}/api/json'
@@ -43,6 +54,38 @@ PARAMS_OF_INTEREST = [
 ]
 
 
+def tree_query(fields):
+    '''
+    Render a list of field names and (name, [subfields]) tuples as
+    a Jenkins tree= query, so that
+    ['id', ('actions', ['_class'])] becomes 'id,actions[_class]'
+    '''
+    parts = []
+    for field in fields:
+        if isinstance(field, tuple):
+            name, subfields = field
+            parts.append('%s[%s]' % (name, tree_query(subfields)))
+        else:
+            parts.append(field)
+    return ','.join(parts)
+
+
+# the only parts of a build that summarize_build() looks at
+BUILD_FIELDS = [
+    'number',
+    'building',
+    'id',
+    'result',
+    'builtOn',
+    ('actions', ['_class', ('parameters', ['name', 'value'])]),
+]
+BUILD_TREE = tree_query(BUILD_FIELDS)
+# just the build list, for fetch_builds()
+JOB_TREE = tree_query([('builds', ['number'])])
+# everything about every build, in one request
+JOB_BUILDS_TREE = tree_query([('builds', BUILD_FIELDS)])
+
+
 log = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 # We don't need to see log entries for each connection opened
@@ -53,17 +96,71 @@ logging.getLogger('urllib3.connectionpool').setLevel(
     logging.WARN)
 
 
-def fetch_job(server, job):
-    r = requests.get(JOB_TEMPLATE.format(server=server, jobname=job))
+def make_session(concurrency=CONCURRENCY):
+    '''
+    Return a requests.Session whose connection pool is big enough to
+    keep one keep-alive connection per worker thread
+    '''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=concurrency,
+        pool_maxsize=concurrency,
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch_job(session, server, job):
+    r = session.get(JOB_TEMPLATE.format(server=server, jobname=job),
+                    params=dict(tree=JOB_TREE))
     r.raise_for_status()
     job = r.json()
     return dict(builds=job['builds'])
 
 
-def fetch_build(server, job, build):
-    r = requests.get(BUILD_TEMPLATE.format(server=server, jobname=job, buildnum=build))
+def fetch_job_builds(session, server, jobnames, cache=None):
+    '''
+    Iterator: fetch the summaries of all builds of each job in
+    jobnames with one request per job.  Yields (jobname, jobbuildinfo,
+    buildinfo) like fetch_builds(); finished builds are added to 'cache'
+    if given.
+    '''
+    for jobname in jobnames:
+        r = session.get(JOB_TEMPLATE.format(server=server, jobname=jobname),
+                        params=dict(tree=JOB_BUILDS_TREE))
+        r.raise_for_status()
+        summaries = [(build['number'], summarize_build(build))
+                     for build in r.json()['builds']]
+        if cache is not None:
+            cache.put_many(server, jobname, summaries, variant='summary')
+        for number, buildinfo in summaries:
+            yield jobname, dict(number=number), buildinfo
+
+
+def fetch_build(session, server, job, build, cache=None):
+    if cache is not None:
+        retdict = cache.get(server, job, build, variant='summary')
+        if retdict is not None:
+            return retdict
+    retdict = _fetch_build(session, server, job, build)
+    if cache is not None:
+        cache.put(server, job, build, retdict, variant='summary')
+    return retdict
+
+
+def _fetch_build(session, server, job, build):
+    r = session.get(BUILD_TEMPLATE.format(server=server, jobname=job, buildnum=build),
+                    params=dict(tree=BUILD_TREE))
     r.raise_for_status()
-    build = r.json()
+    return summarize_build(r.json())
+
+
+def summarize_build(build):
+    '''
+    Reduce a build's api/json (as projected by BUILD_TREE) to the
+    fields and PARAMS_OF_INTEREST we compare on
+    '''
     if build['building']:
         return dict(building=True, id=build['id'], result='IN_PROGRESS')
 
@@ -84,11 +181,39 @@ def fetch_build(server, job, build):
     return retdict
 
 
+def fetch_builds(session, server, jobs, concurrency=CONCURRENCY, cache=None):
+    '''
+    Iterator: fetch every build listed in jobs (jobname: fetch_job() dict)
+    with 'concurrency' worker threads, fetching each build exactly once.
+    Yields (jobname, jobbuildinfo, buildinfo) in completion order.
+    Finished builds are answered from 'cache' if given.
+    '''
+    def _fetch(work):
+        jobname, jobbuildinfo = work
+        return (
+            jobname,
+            jobbuildinfo,
+            fetch_build(session, server, jobname, jobbuildinfo['number'],
+                        cache=cache),
+        )
+
+    work = [(jobname, jobbuildinfo)
+            for jobname, job in jobs.items()
+            for jobbuildinfo in job['builds']]
+    pool = ThreadPool(concurrency)
+    try:
+        for result in pool.imap_unordered(_fetch, work):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
 def read_whitelist(wlpath):
     # format: jobname buildid
-    whitelist = []
+    whitelist = set()
     for l in open(wlpath, 'r'):
-        whitelist.append(tuple(l.split()))
+        whitelist.add(tuple(l.split()))
     return whitelist
 
 
@@ -101,64 +226,209 @@ def valid_buildinfo(jobinfo):
     return buildinfo
 
 
+def read_state(statepath):
+    '''
+    Read the --incremental state file, a JSON map of
+    jobname: {'last': highest build number processed,
+              'in_progress': [build numbers still running last time],
+              'builds': [buildinfo that may still take part in a mismatch]}
+    '''
+    try:
+        with open(statepath, 'r') as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+
+def write_state(statepath, state):
+    tmppath = statepath + '.tmp'
+    with open(tmppath, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmppath, statepath)
+
+
+def new_builds(jobinfo, jobstate):
+    '''
+    Return the builds in jobinfo (from fetch_job()) that are newer than
+    jobstate['last'] or were still in progress last time
+    '''
+    if not jobstate:
+        return jobinfo['builds']
+    in_progress = set(jobstate['in_progress'])
+    return [b for b in jobinfo['builds']
+            if b['number'] > jobstate['last'] or b['number'] in in_progress]
+
+
+def still_listed(builds, numbers):
+    '''
+    Return the state 'builds' entries whose build number is in numbers
+    (the job's builds according to fetch_job()); Jenkins has discarded
+    the others, so they'd only make the state grow forever
+    '''
+    return [b for b in builds if int(b['id']) in numbers]
+
+
+class MismatchFinder(object):
+    '''
+    Index finished builds by ghprbActualCommit as they arrive, and
+    find builds where the first job succeeded and another job didn't
+    for the same sha1, as soon as both sides are known.  Each pair
+    is found exactly once, when the second of the two arrives.
+    '''
+
+    def __init__(self, firstjobname, whitelist):
+        self.firstjobname = firstjobname
+        self.whitelist = whitelist
+        # sha1: jobname: [buildinfo, ...]
+        self.index = defaultdict(lambda: defaultdict(list))
+
+    def add(self, jobname, buildinfo):
+        '''
+        Add buildinfo (None is ignored) and return a list of
+        (firstjobname, firstbuildinfo, jobname, buildinfo) mismatches
+        it completes
+        '''
+        if not buildinfo:
+            return []
+        if (jobname, buildinfo['id']) in self.whitelist:
+            log.debug('whitelisted %s #%s, skipping' % (jobname, buildinfo['id']))
+            return []
+        sha1 = buildinfo.get('ghprbActualCommit')
+        if sha1 is None:
+            return []
+        jobs = self.index[sha1]
+        jobs[jobname].append(buildinfo)
+
+        if jobname == self.firstjobname:
+            if buildinfo['result'] != 'SUCCESS':
+                return []
+            return [
+                (jobname, buildinfo, otherjobname, otherbuildinfo)
+                for otherjobname, otherbuilds in jobs.items()
+                if otherjobname != self.firstjobname
+                for otherbuildinfo in otherbuilds
+                if otherbuildinfo['result'] != 'SUCCESS'
+            ]
+
+        if buildinfo['result'] == 'SUCCESS':
+            return []
+        return [
+            (self.firstjobname, firstbuildinfo, jobname, buildinfo)
+            for firstbuildinfo in jobs.get(self.firstjobname, [])
+            if firstbuildinfo['result'] == 'SUCCESS'
+        ]
+
+    def retained(self):
+        '''
+        Return {jobname: [buildinfo, ...]} of the indexed builds that
+        could still be one side of a mismatch (first job SUCCESS, other
+        jobs not), trimmed to what report_mismatch() needs
+        '''
+        retained = defaultdict(list)
+        for jobs in self.index.values():
+            for jobname, builds in jobs.items():
+                for buildinfo in builds:
+                    if (buildinfo['result'] == 'SUCCESS') != \
+                            (jobname == self.firstjobname):
+                        continue
+                    retained[jobname].append(dict(
+                        (k, buildinfo[k])
+                        for k in ('id', 'result', 'ghprbActualCommit')
+                    ))
+        return retained
+
+
+def report_mismatch(firstjobname, firstbuildinfo, jobname, buildinfo):
+    log.warning(
+        '{sha1:.8s}:: {job1} #{build1}: {res1}   {jobn} #{buildn}: {resn}'.format(
+            sha1=firstbuildinfo['ghprbActualCommit'],
+            job1=firstjobname,
+            build1=firstbuildinfo['id'],
+            res1=firstbuildinfo['result'],
+            jobn=jobname,
+            buildn=buildinfo['id'],
+            resn=buildinfo['result']
+        )
+    )
+
+
+def parse_args(args):
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-c', '--concurrency', type=int, default=CONCURRENCY,
+                    help='number of builds to fetch at once [%(default)s]')
+    ap.add_argument('--no-cache', action='store_true',
+                    help="don't use the local build cache")
+    ap.add_argument('--per-build', action='store_true',
+                    help='fetch builds one request each (concurrently, '
+                    'using the build cache) rather than all of a '
+                    "job's builds in one request")
+    ap.add_argument('-i', '--incremental', action='store_true',
+                    help='only fetch builds that are new or were in progress '
+                    'since the last --incremental run (implies --per-build)')
+    ap.add_argument('--state', default=STATEFILE,
+                    help='state file for --incremental [%(default)s]')
+    ap.add_argument('jobnames', nargs='*', default=DEFAULT_JOBS,
+                    help='jobs to compare; the first is the reference')
+    return ap.parse_args(args)
+
+
 def main(args):
+    args = parse_args(args[1:])
+    jobnames = args.jobnames
     job = {}
-    if len(args) < 2:
-        jobnames = ['ceph-pull-requests', 'ceph-pull-requests-arm64']
-    else:
-        jobnames = args[1:]
 
     # snarf the whitelist file
     whitelist = read_whitelist(
         os.path.expanduser(WHITELIST)
     )
     # slurp it all up
-    for jobname in jobnames:
-        count = 0
-        job[jobname] = fetch_job(SERVER, jobname)
-        for jobbuildinfo in job[jobname]['builds']:
-            buildnum = jobbuildinfo['number']
-            buildinfo = fetch_build(SERVER, jobname, buildnum)
-            jobbuildinfo['buildinfo'] = fetch_build(SERVER, jobname, buildnum)
-            log.debug('%s %s %s' % (jobname, buildinfo['id'], buildinfo['result']))
-            count += 1
-        log.debug('fetched %d builds from %s ' % (count, jobname))
-
-    firstjobname = jobnames[0]
-    for firstjobinfo in job[firstjobname]['builds']:
-        firstbuildinfo = valid_buildinfo(firstjobinfo)
-        if not firstbuildinfo:
-            continue
-        firstbuildnum = firstbuildinfo['id']
-        if (firstjobname, firstbuildnum) in whitelist:
-            log.debug('whitelisted %s #%s, skipping' % (firstjobname, firstbuildnum))
-            continue
-        for jobname in jobnames[1:]:
-            for jobinfo in job[jobname]['builds']:
-                buildinfo = valid_buildinfo(jobinfo)
-                if not buildinfo:
-                    continue
-                buildnum = buildinfo['id']
-                if (jobname, buildnum) in whitelist:
-                    log.debug('whitelisted %s #%s, skipping' % (jobname, buildnum))
-                    continue
-                log.debug("comparing %s:%s and %s:%s" % (
-                    firstjobname, firstbuildnum,
-                    jobname, buildnum
-                ))
-                if firstbuildinfo['ghprbActualCommit'] == buildinfo['ghprbActualCommit']:
-                    if firstbuildinfo['result'] == 'SUCCESS' and buildinfo['result'] != 'SUCCESS':
-                        log.warning(
-                            '{sha1:.8s}:: {job1} #{build1}: {res1}   {jobn} #{buildn}: {resn}'.format(
-                                sha1=firstbuildinfo['ghprbActualCommit'],
-                                job1=firstjobname,
-                                build1=firstbuildnum,
-                                res1=firstbuildinfo['result'],
-                                jobn=jobname,
-                                buildn=buildnum,
-                                resn=buildinfo['result']
-                            )
-                        )
+    session = make_session(args.concurrency)
+    cache = None if args.no_cache else buildcache.default_cache()
+    finder = MismatchFinder(jobnames[0], whitelist)
+    state = {}
+    # jobname: set of the build numbers Jenkins still has
+    listed = {}
+    if args.incremental:
+        statepath = os.path.expanduser(args.state)
+        state = read_state(statepath)
+    if args.per_build or args.incremental:
+        for jobname in jobnames:
+            job[jobname] = fetch_job(session, SERVER, jobname)
+            listed[jobname] = set(b['number'] for b in job[jobname]['builds'])
+            job[jobname]['builds'] = new_builds(job[jobname],
+                                                state.get(jobname))
+        # builds processed last time; already reported, so just index them
+        for jobname in jobnames:
+            for buildinfo in still_listed(
+                    state.get(jobname, {}).get('builds', []),
+                    listed[jobname]):
+                finder.add(jobname, buildinfo)
+        builds = fetch_builds(session, SERVER, job, args.concurrency,
+                              cache=cache)
+    else:
+        builds = fetch_job_builds(session, SERVER, jobnames, cache=cache)
+    # compare as they arrive
+    count = 0
+    for jobname, jobbuildinfo, buildinfo in builds:
+        jobbuildinfo['buildinfo'] = buildinfo
+        log.debug('%s %s %s' % (jobname, buildinfo['id'], buildinfo['result']))
+        count += 1
+        for mismatch in finder.add(jobname, valid_buildinfo(jobbuildinfo)):
+            report_mismatch(*mismatch)
+    log.debug('fetched %d builds from %s' % (count, ', '.join(jobnames)))
+
+    if args.incremental:
+        retained = finder.retained()
+        for jobname in jobnames:
+            jobstate = state.get(jobname, dict(last=0))
+            numbers = [b['number'] for b in job[jobname]['builds']]
+            state[jobname] = dict(
+                last=max(numbers + [jobstate['last']]),
+                in_progress=[b['number'] for b in job[jobname]['builds']
+                             if b['buildinfo']['result'] == 'IN_PROGRESS'],
+                builds=still_listed(retained[jobname], listed[jobname]),
+            )
+        write_state(statepath, state)
 
 
 if __name__ == '__main__':
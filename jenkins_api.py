@@ -15,19 +15,31 @@ builds of 'jobname' at 'url' which match arch, dist, and branch
 If a build matches, check if it was successful.  If so, fetch
 the artifacts from the build, possibly only the packages
 (if onlypkgs is True), using http, and store them in 'path'.
+Artifacts are downloaded concurrently, resuming partial files and
+skipping ones already present with the right size, and kept in the
+local artifact store (see artifactstore.py) so they're only ever
+downloaded once.
 If no suitable artifacts are found, raise an exception.
 
 There is a test main program for experimentation.
 '''
+import itertools
 import logging
 import os
 import re
 import requests
-import shutil
 import time
 
+from collections import defaultdict, namedtuple
+from jenkinsapi.build import Build
 from jenkinsapi.constants import STATUS_SUCCESS
 from jenkinsapi.jenkins import Jenkins
+from urllib import quote, unquote
+from urlparse import urlparse
+
+import artifactstore
+import buildcache
+import download
 
 log = logging.getLogger(__name__)
 # shaddap, you
@@ -45,39 +57,163 @@ DISTTAGS = ['dist', 'Dist', 'Distro']
 # if no arch is specified, accept either of these
 DEFAULT_ARCHES = ['x86_64', 'noarch']
 
+# everything _matching_builds() looks at before it decides a build or
+# matrix run is worth a closer look, so it can get all of them in one
+# query of the job
+_BUILD_TREE = ('number,url,result,building,builtOn,fullDisplayName,'
+               'timestamp,actions[parameters[name,value]]')
+_JOB_TREE = 'allBuilds[{0},runs[{0}]]'.format(_BUILD_TREE)
+
+# url: injected env vars, for builds we've already asked about
+_envvars_memo = dict()
+
 
 def jenkins_url(host):
     return 'http://{0}'.format(host)
 
 
-def _filter_archs(artifacts, archs=None):
+def _cache_key(url):
+    '''
+    Split a build (or matrix run) url into (server, job, buildno) for
+    the build cache; for matrix runs 'job' includes the axis values
+    '''
+    parsed = urlparse(url)
+    jobpath, buildno = parsed.path.rstrip('/').rsplit('/', 1)
+    return parsed.netloc, jobpath, int(buildno)
+
+
+class _CachedBuild(Build):
     '''
-    Return a subset of 'artifacts' containing only those who match an
-    arch in 'archs'.  'match' means: appears after ARCHTAG in the URL,
-    or, if 'noarch' is in archs, whose URL doesn't mention any ARCHTAG,
-    implying they are noarch.
+    A jenkinsapi Build whose full poll is answered from the build cache,
+    and whose matrix runs are _CachedBuilds as well.  Polls of a subtree
+    (tree=...) always go to the server.
 
-    :param artifacts: full list of artifacts
+    If 'data' is given (say, from a bulk _JOB_TREE query) it's used as
+    the result of the first poll, so constructing the build costs nothing.
+    '''
+
+    def __init__(self, url, buildno, job, data=None):
+        self._prefetched = data
+        Build.__init__(self, url, buildno, job)
+
+    def _poll(self, tree=None):
+        if not tree and self._prefetched is not None:
+            data, self._prefetched = self._prefetched, None
+            return data
+        cache = buildcache.default_cache()
+        if tree or cache is None:
+            return Build._poll(self, tree=tree)
+        server, job, buildno = _cache_key(self.baseurl)
+        data = cache.get(server, job, buildno)
+        if data is None:
+            data = Build._poll(self)
+            cache.put(server, job, buildno, data)
+        return data
+
+    def get_matrix_runs(self):
+        if 'runs' in self._data:
+            for rinfo in self._data['runs']:
+                number = rinfo['number']
+                if number == self._data['number']:
+                    data = rinfo if 'fullDisplayName' in rinfo else None
+                    yield _CachedBuild(rinfo['url'], number, self.job,
+                                       data=data)
+
+
+# an artifact, with the arch, dist and package type (file extension)
+# picked out of its url, and its md5 if Jenkins fingerprinted it;
+# see _parse_artifact()
+_Artifact = namedtuple('_Artifact', 'url filename arch dist pkgtype md5')
+# what _artifact_index() asks a build for
+_ARTIFACT_TREE = 'artifacts[relativePath,fileName],fingerprint[fileName,hash]'
+
+
+def _parse_artifact(url, filename, md5=None):
+    '''
+    Parse the ARCHTAGS=arch and DISTTAGS=dist axis values out of an
+    artifact url (matrix run urls look like .../Arch=x86_64,Dist=trusty/...)
+    and return an _Artifact.  Artifacts without an arch axis are
+    taken to be noarch.
+    '''
+    axes = dict()
+    for segment in unquote(urlparse(url).path).split('/'):
+        for pair in segment.split(','):
+            if '=' in pair:
+                k, v = pair.split('=', 1)
+                axes.setdefault(k, v)
+    arch = next((axes[t] for t in ARCHTAGS if t in axes), 'noarch')
+    dist = next((axes[t] for t in DISTTAGS if t in axes), None)
+    pkgtype = filename.rsplit('.', 1)[-1] if '.' in filename else None
+    return _Artifact(url, filename, arch, dist, pkgtype, md5)
+
+
+class _ArtifactIndex(object):
+    '''
+    The artifacts of one build, indexed so that lookup() by any
+    combination of arch, dist and pkgtype is a single dict access
+    '''
+
+    def __init__(self, artifacts):
+        self.artifacts = list(artifacts)
+        self._index = defaultdict(list)
+        for a in self.artifacts:
+            # file a under every combination of its fields and None
+            for key in set(itertools.product((a.arch, None), (a.dist, None),
+                                             (a.pkgtype, None))):
+                self._index[key].append(a)
+
+    def lookup(self, arch=None, dist=None, pkgtype=None):
+        ''' Return artifacts matching the given fields (None matches any) '''
+        return self._index.get((arch, dist, pkgtype), [])
+
+
+def _artifact_index(build):
+    '''
+    Return the _ArtifactIndex for build, from the build cache if it's
+    there; otherwise fetch the artifact list (and fingerprints, for the
+    md5s) and cache the index
+    '''
+    cache = buildcache.default_cache()
+    if cache is not None:
+        server, job, buildno = _cache_key(build._data['url'])
+        cached = cache.get(server, job, buildno, variant='artifact-index')
+        if cached is not None:
+            return _ArtifactIndex(_Artifact(*a) for a in cached['artifacts'])
+    data = build.poll(tree=_ARTIFACT_TREE)
+    md5s = dict((os.path.basename(fp['fileName']), fp['hash'])
+                for fp in data.get('fingerprint', []))
+    index = _ArtifactIndex(
+        _parse_artifact(
+            '%s/artifact/%s' % (build.baseurl, quote(a['relativePath'])),
+            a['fileName'],
+            md5s.get(a['fileName']),
+        )
+        for a in data['artifacts']
+    )
+    if cache is not None and not build._data['building']:
+        cache.put(server, job, buildno,
+                  dict(artifacts=[list(a) for a in index.artifacts]),
+                  variant='artifact-index')
+    return index
+
+
+def _filter_archs(index, archs=None, pkgtype=None):
+    '''
+    Return the artifacts in 'index' that match an arch in 'archs'.
+    'match' means: appears after ARCHTAG in the URL, or, if 'noarch'
+    is in archs, whose URL doesn't mention any ARCHTAG, implying they
+    are noarch.
+
+    :param index: _ArtifactIndex of a build's artifacts
     :param archs: arch values to search for (default to DEFAULT_ARCHS)
+    :param pkgtype: if not None, only artifacts with this file extension
     :return: filtered list of artifacts
     '''
-    # have all artifacts; filter for arch by looking in url path
     if archs is None:
         archs = DEFAULT_ARCHES
     filtered = []
     for arch in archs:
-        for archtag in ARCHTAGS:
-            filtered.extend([a for a in artifacts
-                             if '{}={}'.format(archtag, arch) in a.url])
-            log.debug('filter arches: archtag %s: list now %s',
-                      archtag, filtered)
-        if arch == 'noarch':
-            # add any artifacts that have no {ARCHTAGS}= in their URLs at all
-            noarch_arts = [a for a in artifacts
-                           if not any([t + '=' in a.url for t in ARCHTAGS])]
-            log.debug('_filter_archs: adding noarch artifacts %s', noarch_arts)
-            filtered.extend(noarch_arts)
-
+        filtered.extend(index.lookup(arch=arch, pkgtype=pkgtype))
     log.debug('_filter_archs: returning %s', filtered)
     return filtered
 
@@ -105,10 +241,20 @@ def _get_build_envvars(build):
     Return a dict of var:value for the 'injected environment variables',
     if present (and an empty dict if not)
     '''
+    url = build._data['url']
+    if url in _envvars_memo:
+        return _envvars_memo[url]
+    cache = buildcache.default_cache()
+    if cache is not None:
+        server, job, buildno = _cache_key(url)
+        envvars = cache.get(server, job, buildno, variant='envvars')
+        if envvars is not None:
+            _envvars_memo[url] = envvars
+            return envvars
     envvars = dict()
     try:
         resp = requests.get(
-            build._data['url'] + 'injectedEnvVars/export',
+            url + 'injectedEnvVars/export',
             headers={'Accept': 'application/json'},
         )
         resp.raise_for_status()
@@ -116,7 +262,10 @@ def _get_build_envvars(build):
         for vardict in resp.json()['envVars']['envVar']:
             envvars[vardict['name']] = vardict['value']
     except:
-        pass
+        return envvars
+    _envvars_memo[url] = envvars
+    if cache is not None and not build._data['building']:
+        cache.put(server, job, buildno, envvars, variant='envvars')
     return envvars
 
 
@@ -235,15 +384,33 @@ def _build_matches(build, arch, distrover, branch, is_matrix=False):
     )
 
 
-def _matching_builds(url, jobname, arch, distrover, branch=None):
+def _cheap_match(build, branch, successful):
+    '''
+    Return True if build passes the checks that don't need any more
+    requests: branch (if given) and, if 'successful', build status
+    '''
+    if branch is not None and build.branch != branch:
+        return False
+    return not successful or _successful(build)
+
+
+def _matching_builds(url, jobname, arch, distrover, branch=None,
+                     successful=False):
     '''
     Iterator: return builds of jobname, in newest-first order, that
-    match arch/distrover/optional branch (if there are any).
+    match arch/distrover/optional branch (if there are any), and
+    that were successful if 'successful' is True.
+
+    Status, branch and builtOn of all builds and runs come from one
+    query of the job; only those that pass _cheap_match() go on to
+    the per-build env var lookup in _has_arch_distrover().
     '''
     job = Jenkins(url)[jobname]
-    # get_build_ids() returns in newest-to-oldest order
-    for buildno in job.get_build_ids():
-        build = job.get_build(buildno)
+    jobdata = job.poll(tree=_JOB_TREE)
+    # newest-to-oldest order
+    for data in sorted(jobdata['allBuilds'], key=lambda b: b['number'],
+                       reverse=True):
+        build = _CachedBuild(data['url'], data['number'], job, data=data)
         build.lname = str(build).decode('utf-8', 'ignore')
         _set_branch(build)
         # set dist and arch later in the horrible _has_arch_distrover
@@ -252,10 +419,14 @@ def _matching_builds(url, jobname, arch, distrover, branch=None):
         for run in build.get_matrix_runs():
             run.lname = str(run).decode('utf-8', 'ignore')
             _set_branch(run)
+            if not _cheap_match(run, branch, successful):
+                continue
             if _build_matches(run, arch, distrover, branch, is_matrix=True):
                 yield run
         else:
-            if _build_matches(build, arch, distrover, branch, is_matrix=False):
+            if _cheap_match(build, branch, successful) and \
+                    _build_matches(build, arch, distrover, branch,
+                                   is_matrix=False):
                 yield build
 
     raise StopIteration
@@ -265,7 +436,8 @@ def _find_matching_good_build(url, jobname, arch, distrover, branch=None):
     '''
     Return _matching_builds() filtering for successful builds
     '''
-    for build in _matching_builds(url, jobname, arch, distrover, branch):
+    for build in _matching_builds(url, jobname, arch, distrover, branch,
+                                  successful=True):
         if _successful(build):
             tag=None
             for disttag in DISTTAGS:
@@ -303,10 +475,10 @@ def _get_job_artifacts(host, jobname, distrover=None, arch=None, branch=None,
 
         log.info('FOUND %s branch %s built %s', build.lname, build.branch,
                  time.ctime(build._data['timestamp'] / 1000))
-        artifacts = [a for a in build.get_artifacts()]
-        if onlypkgs:
-            artifacts = [a for a in artifacts if a.url.endswith('rpm') or a.url.endswith('deb')]
-        artifacts = _filter_archs(artifacts, ('x86_64', 'noarch'))
+        index = _artifact_index(build)
+        artifacts = []
+        for pkgtype in (('rpm', 'deb') if onlypkgs else (None,)):
+            artifacts.extend(_filter_archs(index, ('x86_64', 'noarch'), pkgtype))
         if match_jobname:
             artifacts = [a for a in artifacts if a.filename.startswith(jobname)]
         all_artifacts.extend(artifacts)
@@ -320,7 +492,8 @@ def _get_job_artifacts(host, jobname, distrover=None, arch=None, branch=None,
 
 
 def fetch_job_output(host, jobname, distrover=None, arch='x86_64', branch=None,
-                     onlypkgs=True, path='.', match_jobname=False):
+                     onlypkgs=True, path='.', match_jobname=False,
+                     concurrency=download.CONCURRENCY):
     '''
     Get latest packages from build artifacts from jobname for distrover;
     store at path.  Raise exception if a suitable build is not found.
@@ -334,14 +507,11 @@ def fetch_job_output(host, jobname, distrover=None, arch='x86_64', branch=None,
     :param arch: architecture
     :param onlypkgs: if true, return only 'rpm' or 'deb' files
     :param path: local path to store package files
+    :param concurrency: number of artifacts to download at once
     :return: disttype (debian or rpm)
     '''
     log.info("get_job_output(%s, %s, %s, %s, %s)",
              host, jobname, distrover, arch, path)
-    requests_getargs = {
-        'allow_redirects': True,
-        'stream': True,
-    }
     artifacts = _get_job_artifacts(host, jobname, distrover, arch,
                                    branch, onlypkgs, path, match_jobname=match_jobname)
     if not artifacts:
@@ -355,22 +525,42 @@ def fetch_job_output(host, jobname, distrover=None, arch='x86_64', branch=None,
         )
         raise RuntimeError(msg)
 
-    disttype = 'debian'
+    # go through the artifact store if there is one, checking the
+    # Jenkins fingerprint md5 where we have it
+    store = artifactstore.default_store()
+    fetch = None
+    if store is not None:
+        md5s = dict((a.url, a.md5) for a in artifacts)
+
+        def fetch(session, url, dest):
+            checksum = ('md5', md5s[url]) if md5s[url] else None
+            return store.fetch(session, url, dest, checksum=checksum)
+
+    # artifacts of different builds can have the same filename; as
+    # when they were fetched one after another, the last one wins
+    urls = dict()
     for a in artifacts:
-        log.debug('Fetch %s', a.url)
-        response = requests.get(a.url, **requests_getargs)
-        response.raise_for_status()
-        with open(os.path.join(path, a.filename), 'w') as f:
-            shutil.copyfileobj(response.raw, f)
-        if a.url.endswith('rpm'):
-            disttype = 'rpm'
+        dest = os.path.join(path, a.filename)
+        if dest in urls and urls[dest] != a.url:
+            log.warning('%s: using %s, not %s', dest, a.url, urls[dest])
+        urls[dest] = a.url
+    download.download_all(
+        download.make_session(concurrency),
+        [(url, dest) for dest, url in urls.items()],
+        concurrency=concurrency,
+        fetch=fetch,
+    )
+    disttype = 'debian'
+    if any(a.url.endswith('rpm') for a in artifacts):
+        disttype = 'rpm'
 
     return disttype
 
 
 docstr = '''
 Usage: {progname} [--host JENKINS] --jobname JOBNAME [--arch ARCH] [--distrover DISTROVER]
-       [--branch BRANCH] [--limit LIMIT] [--onlypkgs] (--path OUTPUT | --list) [--verbose]
+       [--branch BRANCH] [--limit LIMIT] [--onlypkgs] [--concurrency N]
+       (--path OUTPUT | --list) [--verbose]
 
 Get packages from Jenkins server
 
@@ -385,6 +575,7 @@ Options:
   --onlypkgs                 Fetch only rpm/deb [default: False]
   --list, -l                 List artifact urls, do not retrieve
   --path, -p OUTPUT          Output path for retrieved artifacts [default: .]
+  --concurrency, -c N        Number of artifacts to download at once [default: 4]
   --verbose, -v              Show all your work
 '''
 
@@ -402,12 +593,13 @@ def main():
     if args['verbose']:
         log.setLevel(logging.DEBUG)
     args.pop('verbose')
+    concurrency = int(args.pop('concurrency'))
     do_list = args.pop('list')
     if do_list:
         for a in _get_job_artifacts(**args):
             print a.url
         sys.exit(0)
-    fetch_job_output(**args)
+    fetch_job_output(concurrency=concurrency, **args)
 
 if __name__ == '__main__':
     main()
@@ -8,10 +8,15 @@ import os
 import re
 import sys
 
+import buildcache
+
+JENKINS_HOST = 'jenkins.ceph.com'
+
 def parse_args():
     ap = argparse.ArgumentParser()
     ap.add_argument("-j", "--json", action='store_true', help="Output json")
     ap.add_argument("-P", "--allparams", action='store_true', help="Output all job parameters")
+    ap.add_argument("--no-cache", action='store_true', help="Don't use the local build cache")
     ap.add_argument('jobre', type=str, nargs="?", default='^ceph-dev-new$', help="regexp to match job name")
     return ap.parse_args() 
 
@@ -66,12 +71,27 @@ def output(name, buildnum, reason, paramdict, timestr, bi, returndict=False):
         print(f'took {to_minsec(bi["duration"])} {bi["result"]}')
 
 
+def get_build_info(j, cache, name, buildnum):
+    '''
+    j.get_build_info(), but answered from cache for finished builds
+    '''
+    if cache is not None:
+        bi = cache.get(JENKINS_HOST, name, buildnum)
+        if bi is not None:
+            return bi
+    bi = j.get_build_info(name, buildnum)
+    if cache is not None:
+        cache.put(JENKINS_HOST, name, buildnum, bi)
+    return bi
+
+
 def main():
     jenkins_user=os.environ.get('JENKINS_USER')
     jenkins_token=os.environ.get('JENKINS_TOKEN')
-    j=jenkins.Jenkins('https://jenkins.ceph.com', jenkins_user, jenkins_token)
+    j=jenkins.Jenkins(f'https://{JENKINS_HOST}', jenkins_user, jenkins_token)
 
     args = parse_args()
+    cache = None if args.no_cache else buildcache.default_cache()
 
     # jobinfo = j.get_job_info_regex(args.jobre)
     # get_job_info_regex doesn't allow passing "fetch_all_builds", so
@@ -89,7 +109,7 @@ def main():
             outdict = dict(name=name, builds=list())
         for build in ji['builds']:
             buildnum = build['number']
-            bi = j.get_build_info(name, buildnum)
+            bi = get_build_info(j, cache, name, buildnum)
             '''
             example CauseAction in actions[]:
             {'_class': 'hudson.model.CauseAction',
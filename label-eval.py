@@ -1,10 +1,48 @@
 #!/usr/bin/env python
 
+import argparse
 import ast
+import collections
+import operator
+import os
 import pprint
 import re
 import sys
+import time
 
+JENKINS_HOST = 'jenkins.ceph.com'
+NODES_TREE = 'computer[displayName,offline,assignedLabels[name]]'
+# how many parsed/compiled expressions to keep
+CACHE_SIZE = 1024
+
+
+class LRUCache(object):
+    '''
+    A dict-like cache of at most 'size' entries; putting one more
+    forgets the least recently used
+    '''
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.entries = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            return default
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+# The old way of parsing expressions, rewriting them as Python for
+# ast.parse(); only kept for comparison by -B (see benchmark())
 class UnsafeNodeType(Exception):
     ''' Unsafe node type found '''
 
@@ -65,50 +103,256 @@ def pythonize_boolean(expr):
     return expr.strip()
 
 
-def validate_and_parse(expr):
+class LabelSyntaxError(SyntaxError):
+    ''' Malformed label expression '''
+
+
+# Jenkins label expression grammar, loosest-binding first:
+#
+#   expr   := iff
+#   iff    := imp ('<->' imp)*
+#   imp    := or ('->' or)*
+#   or     := and ('||' and)*
+#   and    := not ('&&' not)*
+#   not    := '!' not | '(' expr ')' | label
+#   label  := bare label, or "quoted label" with \-escapes
+#
+# A bare label is anything but whitespace, & | ! ( ) and ", so
+# centos-9, x86_64 and ubuntu-20.04 are all labels; '-' and '<' are
+# only operators as part of -> and <->.
+_TOKEN_RE = re.compile(r'''
+    \s*(?:
+        (?P<op><->|->|&&|\|\||!|\(|\))
+      | "(?P<quoted>(?:[^"\\]|\\.)*)"
+      | (?P<label>(?:[^\s&|!()"<-]|-(?!>)|<(?!->))+)
+      | (?P<bad>\S)
+    )''', re.VERBOSE)
+_BARE_LABEL_RE = re.compile(r'(?:[^\s&|!()"<-]|-(?!>)|<(?!->))+$')
+_UNESCAPE_RE = re.compile(r'\\(.)')
+_END = (None, None)
+
+
+def tokenize(expr):
     '''
-    Parse to collect names mentioned in expr.  Only allow
-    expressions with terminals mentioned in myvisitor()
-    (for safety).
+    Return the tokens of label expression expr as a list of (kind,
+    value), kind 'op' or 'label', ending with _END
     '''
-    tree=ast.parse(expr)
-    visitor = myvisitor()
-    visitor.visit(tree)
-    return visitor.names
+    tokens = list()
+    for m in _TOKEN_RE.finditer(expr):
+        kind = m.lastgroup
+        if kind == 'label' or kind == 'op':
+            tokens.append((kind, m.group(kind)))
+        elif kind == 'quoted':
+            tokens.append(('label', _UNESCAPE_RE.sub(r'\1', m.group(kind))))
+        elif kind == 'bad':
+            raise LabelSyntaxError('bad character at %d in %r' % (
+                m.start(kind), expr))
+    tokens.append(_END)
+    return tokens
 
 
-def matching_slaves(expr, slaves):
-    '''Returns a list of slaves that match expr'''
-    # return value
-    matching_slaves = list()
+# A parsed expression is a label name (a string), or a tuple of an
+# operator and its operands: ('!', x), ('&&', x, y, ...),
+# ('||', x, y, ...), ('->', x, y) or ('<->', x, y).  Chains of && and
+# || are flattened into one node.
+
+class _Parser(object):
+    ''' Recursive-descent parser over the tokens of one expression '''
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.tokens = tokenize(expr)
+        self.pos = 0
+
+    def error(self, what):
+        kind, value = self.tokens[self.pos]
+        raise LabelSyntaxError('%s, found %s in %r' % (
+            what, 'end' if kind is None else repr(value), self.expr))
+
+    def peek_op(self, op):
+        return self.tokens[self.pos] == ('op', op)
+
+    def parse(self):
+        tree = self._iff()
+        if self.tokens[self.pos] != _END:
+            self.error('expected operator')
+        return tree
+
+    def _binary(self, op, operand):
+        operands = [operand()]
+        while self.peek_op(op):
+            self.pos += 1
+            operands.append(operand())
+        if len(operands) == 1:
+            return operands[0]
+        if op in ('&&', '||'):
+            flat = list()
+            for x in operands:
+                if isinstance(x, tuple) and x[0] == op:
+                    flat.extend(x[1:])
+                else:
+                    flat.append(x)
+            return (op,) + tuple(flat)
+        # -> and <-> associate to the left
+        tree = operands[0]
+        for x in operands[1:]:
+            tree = (op, tree, x)
+        return tree
+
+    def _iff(self):
+        return self._binary('<->', self._imp)
+
+    def _imp(self):
+        return self._binary('->', self._or)
+
+    def _or(self):
+        return self._binary('||', self._and)
+
+    def _and(self):
+        return self._binary('&&', self._not)
+
+    def _not(self):
+        kind, value = self.tokens[self.pos]
+        if kind == 'label':
+            self.pos += 1
+            return value
+        if value == '!':
+            self.pos += 1
+            return ('!', self._not())
+        if value == '(':
+            self.pos += 1
+            tree = self._iff()
+            if not self.peek_op(')'):
+                self.error("expected ')'")
+            self.pos += 1
+            return tree
+        self.error('expected label')
+
+
+def parse_label_expr(expr):
+    ''' Parse Jenkins label expression expr; see _Parser '''
+    return _Parser(expr).parse()
+
+
+def _compile_mask_node(tree):
+    '''
+    Turn a parsed expression tree into a function that takes a
+    SlaveSet and returns the bitmask of all the slaves that match
+    '''
+    if not isinstance(tree, tuple):
+        return lambda slaveset: slaveset.masks.get(tree, 0)
+    op = tree[0]
+    values = [_compile_mask_node(x) for x in tree[1:]]
+    if op == '!':
+        operand = values[0]
+        return lambda slaveset: slaveset.all ^ operand(slaveset)
+    if op == '&&':
+        return lambda slaveset: reduce(
+            operator.and_, (v(slaveset) for v in values), slaveset.all)
+    if op == '||':
+        return lambda slaveset: reduce(
+            operator.or_, (v(slaveset) for v in values), 0)
+    left, right = values
+    if op == '->':
+        return lambda slaveset: (slaveset.all ^ left(slaveset)) | right(slaveset)
+    return lambda slaveset: slaveset.all ^ left(slaveset) ^ right(slaveset)
+
+
+# expr: compiled function, so each expression is only parsed once
+_compiled_masks = LRUCache()
+# expr: parsed tree
+_label_trees = LRUCache()
+
+
+def _parse(expr):
+    ''' Parse expr to a tree, only once for each distinct expr '''
+    tree = _label_trees.get(expr)
+    if tree is None:
+        tree = parse_label_expr(expr)
+        _label_trees.put(expr, tree)
+    return tree
+
+
+# how tightly each operator binds; labels bind tightest
+_PRECEDENCE = {'<->': 1, '->': 2, '||': 3, '&&': 4, '!': 5}
+
+
+def _canonical_node(tree, outer=0):
+    ''' Render tree, parenthesized if it binds less tightly than outer '''
+    if not isinstance(tree, tuple):
+        if _BARE_LABEL_RE.match(tree):
+            return tree
+        return '"%s"' % tree.replace('\\', '\\\\').replace('"', '\\"')
+    op = tree[0]
+    prec = _PRECEDENCE[op]
+    if op == '!':
+        text = '!' + _canonical_node(tree[1], prec)
+    elif op in ('&&', '||'):
+        values = set(_canonical_node(x, prec + 1) for x in tree[1:])
+        text = (' %s ' % op).join(sorted(values))
+    else:
+        text = '%s %s %s' % (_canonical_node(tree[1], prec), op,
+                             _canonical_node(tree[2], prec + 1))
+    return '(' + text + ')' if prec < outer else text
+
+
+def canonicalize(expr):
+    '''
+    Return expr in a canonical form: single spaces around binary
+    operators, only the parentheses it needs, and the operands of each
+    && and || sorted and deduplicated, so that different spellings of
+    the same expression compare equal
+    '''
+    return _canonical_node(_parse(expr))
+
+
+def compile_mask_expr(expr):
+    '''
+    Return a function that takes a SlaveSet and returns the bitmask
+    of its slaves that satisfy expr
+    '''
+    func = _compiled_masks.get(expr)
+    if func is None:
+        func = _compile_mask_node(_parse(expr))
+        _compiled_masks.put(expr, func)
+    return func
 
-    expr = pythonize_boolean(expr)
 
-    # collect all expr's names
-    names = validate_and_parse(expr)
+class SlaveSet(object):
+    '''
+    A slaves dict (name: [labels]) stored as one bitmask per label, bit
+    i set if slave i has that label, so an expression is evaluated for
+    every slave at once with a few &, | and ^ on the masks.  Build it
+    once and call matching() for as many expressions as you like.
+    '''
 
-    # all the names in expr, initialized to "False"
-    symdict = {k: False for k in names}
+    def __init__(self, slaves):
+        self.names = sorted(slaves)
+        self.all = (1 << len(self.names)) - 1
+        self.masks = dict()
+        for i, name in enumerate(self.names):
+            for label in slaves[name]:
+                self.masks[label] = self.masks.get(label, 0) | (1 << i)
 
-    for slavename, labels in slaves.iteritems():
-        # copy for this particular slave
-        localdict = dict(symdict)
+    def names_in(self, mask):
+        ''' Return the names of the slaves whose bits are set in mask '''
+        names = list()
+        while mask:
+            low = mask & -mask
+            names.append(self.names[low.bit_length() - 1])
+            mask ^= low
+        return names
 
-        # Note labels supplied by slavename as 'True' in localdict
-        # (we could limit this only to labels that already
-        # exist in the expression, but there's not much point;
-        # if the expression doesn't care it doesn't care in the
-        # eval() below either)
-        for label in labels:
-            localdict[label] = True
+    def matching(self, expr):
+        ''' Return the names of the slaves that satisfy expr '''
+        return self.names_in(compile_mask_expr(expr)(self))
 
-        # localdict is now the intersection of labels mentioned in e
-        # and labels supplied by slave, with True/False set
-        # appropriately for this slave. 
-        if eval(expr, globals(), localdict) is True:
-            matching_slaves.append(slavename)
 
-    return matching_slaves
+def matching_slaves(expr, slaves):
+    '''Returns a list of slaves that match expr'''
+    if not isinstance(slaves, SlaveSet):
+        slaves = SlaveSet(slaves)
+    return slaves.matching(expr)
 
 
 slaves = {
@@ -119,17 +363,202 @@ slaves = {
 }
 
 
+def jenkins_slaves(host, offline=False):
+    '''
+    Return a slaves dict (name: [labels]) of the nodes of Jenkins
+    server 'host'; online ones only unless offline
+    '''
+    import requests
+    res = requests.get('https://%s/computer/api/json' % host,
+                       params=dict(tree=NODES_TREE))
+    res.raise_for_status()
+    return dict(
+        (node['displayName'], [l['name'] for l in node['assignedLabels']])
+        for node in res.json()['computer']
+        if offline or not node['offline']
+    )
+
+
+def read_expressions(f):
+    '''
+    Yield (source, expr) for each expression in file f, one per line;
+    blank lines and #-comments are skipped, source is 'file:line'
+    '''
+    for lineno, line in enumerate(f, 1):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield '%s:%d' % (f.name, lineno), line
+
+
+def _node_exprs(obj, source):
+    if isinstance(obj, dict):
+        source = obj.get('name', source)
+        node = obj.get('node')
+        if isinstance(node, basestring):
+            yield source, node
+        for value in obj.itervalues():
+            for found in _node_exprs(value, source):
+                yield found
+    elif isinstance(obj, list):
+        for value in obj:
+            for found in _node_exprs(value, source):
+                yield found
+
+
+def read_job_yaml(f):
+    '''
+    Yield (job name, expr) for each 'node:' label expression in the
+    jenkins-job-builder YAML file f.  Expressions still containing
+    {template} parameters can't be evaluated, and are skipped.
+    '''
+    # only batch mode needs yaml, so the demo runs on plain python
+    import yaml
+
+    class JobLoader(yaml.SafeLoader):
+        ''' SafeLoader that reads jenkins-job-builder's !include etc. as None '''
+
+    JobLoader.add_multi_constructor('!', lambda loader, suffix, node: None)
+    for source, expr in _node_exprs(yaml.load(f, Loader=JobLoader), f.name):
+        if '{' in expr:
+            print >> sys.stderr, '%s: skipping template expression %s' % (
+                source, expr)
+            continue
+        yield source, expr
+
+
+def evaluate_batch(exprs, slaveset):
+    '''
+    Evaluate (source, expr) pairs against slaveset, each distinct
+    expression only once.  Return a list, in order of first
+    appearance, of (canonical expr, sources, matching slave names
+    or None, error or None).
+    '''
+    results = collections.OrderedDict()
+    for source, expr in exprs:
+        try:
+            key = canonicalize(expr)
+        except LabelSyntaxError as exc:
+            key = expr
+            error = exc
+        else:
+            error = None
+        if key not in results:
+            if error is None:
+                results[key] = (list(), slaveset.matching(key), None)
+            else:
+                results[key] = (list(), None, error)
+        results[key][0].append(source)
+    return [(expr,) + result for expr, result in results.iteritems()]
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(
+        description='Find the Jenkins nodes matching label expressions; '
+                    'with no expressions, run a demo against built-in slaves')
+    ap.add_argument('-e', '--exprs', type=argparse.FileType('r'),
+                    action='append', default=[],
+                    help='file of label expressions, one per line (- for stdin)')
+    ap.add_argument('-y', '--yaml', type=argparse.FileType('r'),
+                    action='append', default=[],
+                    help='jenkins-job-builder YAML file to take node: expressions from')
+    ap.add_argument('-o', '--offline', action='store_true',
+                    help='count offline nodes as well')
+    ap.add_argument('-u', '--unschedulable', action='store_true',
+                    help='only report expressions no node matches')
+    ap.add_argument('-v', '--verbose', action='store_true',
+                    help='list where each expression came from')
+    ap.add_argument('-B', '--benchmark', type=int, metavar='N',
+                    help='time parsing the expressions (or the demo ones) N '
+                         'times, old way and new, instead of evaluating them')
+    return ap.parse_args()
+
+
+def _read_inputs(args):
+    exprs = list()
+    for f in args.exprs:
+        exprs.extend(read_expressions(f))
+    for f in args.yaml:
+        exprs.extend(read_job_yaml(f))
+    return exprs
+
+
+def _ast_parse(expr):
+    ''' The old way: rewrite expr as Python, ast.parse() and validate it '''
+    tree = ast.parse(pythonize_boolean(expr))
+    myvisitor().visit(tree)
+    return tree
+
+
+def benchmark(exprs, number):
+    '''
+    Print how long parsing each of exprs 'number' times takes with
+    _ast_parse() and with parse_label_expr(), skipping any that the
+    old way can't handle
+    '''
+    usable = list()
+    for expr in exprs:
+        try:
+            _ast_parse(expr)
+            parse_label_expr(expr)
+        except (UnsafeNodeType, SyntaxError):
+            continue
+        usable.append(expr)
+    print '%d of %d expressions parse both ways' % (len(usable), len(exprs))
+    for name, parse in (('pythonize_boolean + ast.parse', _ast_parse),
+                        ('parse_label_expr', parse_label_expr)):
+        start = time.time()
+        for i in xrange(number):
+            for expr in usable:
+                parse(expr)
+        elapsed = time.time() - start
+        print '%s: %.3fs, %.1f us per expression' % (
+            name, elapsed, 1e6 * elapsed / max(number * len(usable), 1))
+
+
+def batch(args):
+    host = os.environ.get('JENKINS_HOST', JENKINS_HOST)
+    slaveset = SlaveSet(jenkins_slaves(host, args.offline))
+    exprs = _read_inputs(args)
+
+    failed = 0
+    for expr, sources, names, error in evaluate_batch(exprs, slaveset):
+        if error is not None:
+            print '%s: %s' % (expr, error)
+        elif not names:
+            print '%s: NO MATCHING NODES' % expr
+        elif args.unschedulable:
+            continue
+        else:
+            print '%s: %s' % (expr, ' '.join(names))
+        if error is not None or not names:
+            failed += 1
+        if args.verbose:
+            print '    ' + ', '.join(sources)
+    return 1 if failed else 0
+
+
+TESTEXPRS = ['"ABC".tolower()', 'trusty&&!huge', 'trusty', 'trusty && huge', 'trusty && arm64', '!trusty',
+             'trusty && (amd64 || arm64)', 'huge -> amd64', 'small <-> !huge', 'centos-9 || trusty_small']
+
+
 def main():
-    TESTEXPRS = ['"ABC".tolower()', 'trusty&&!huge', 'trusty', 'trusty && huge', 'trusty && arm64', '!trusty']
+    args = parse_args()
+    if args.benchmark:
+        exprs = [expr for source, expr in _read_inputs(args)] or TESTEXPRS
+        return benchmark(exprs, args.benchmark)
+    if args.exprs or args.yaml:
+        return batch(args)
+
     pp = pprint.PrettyPrinter().pprint
     print 'slaves:'
     pp(slaves)
     print
 
+    slaveset = SlaveSet(slaves)
     for e in TESTEXPRS:
         try:
-            result = matching_slaves(e, slaves)
-        except UnsafeNodeType as exc:
+            result = matching_slaves(e, slaveset)
+        except LabelSyntaxError as exc:
             print e, 'causes', exc
             continue
         print '"%s" matches %s' % (e, result)
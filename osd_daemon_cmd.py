@@ -1,67 +1,248 @@
 #! /usr/bin/env python
 
 import docopt
-import os
 import json
 import paramiko
+import pipes
+import shlex
 import socket
 import subprocess
 import sys
+import time
 import yaml
 
+from multiprocessing.pool import ThreadPool
 
-def do_daemon_command(host, osdlist, cmd):
+import crushtree
+import ssh
+import sshpool
+
+# hosts to talk to at once
+CONCURRENCY = 16
+# seconds to give each host
+TIMEOUT = 60
+
+
+def _connect(host, timeout):
+    '''
+    Return (paramiko client connected to host, None), or (None, error
+    message).  If 'host' contains an '@', it will be split into user
+    and host.  The client comes from the shared ssh connection pool;
+    give it back with _disconnect().
+    '''
+    try:
+        return sshpool.default_pool().acquire(host, min(15, timeout)), None
+    except paramiko.SSHException:
+        return None, "Can't connect to %s" % sshpool.split_host(host)[1]
+    except socket.error, v:
+        return None, "Can't connect to %s: %s" % (sshpool.split_host(host)[1], v)
+
+
+def _disconnect(host, client):
+    sshpool.default_pool().release(host, client)
+
+
+def _run_command(client, command, deadline, input=None):
+    '''
+    Run command over client, feeding it input (if any) on stdin, and
+    read its stdout and stderr both as they arrive until it exits or
+    time.time() passes deadline.  Return (exit status, stdout, stderr);
+    the exit status is None if it timed out, and stdout and stderr are
+    what came before then.  Raises paramiko.SSHException if the command
+    can't be started, socket.timeout if input can't be sent in time.
+    '''
+    channel = client.get_transport().open_session()
+    try:
+        channel.exec_command(command)
+        if input is not None:
+            channel.settimeout(max(0, deadline - time.time()))
+            channel.sendall(input)
+            channel.shutdown_write()
+        out = list()
+        err = list()
+        rc = ssh.read_output(channel, out.append, err.append,
+                             deadline - time.time())
+        return rc, ''.join(out), ''.join(err)
+    finally:
+        channel.close()
+
+
+def _format_output(o, out):
+    '''
+    Return the lines to show for osd o's output: its name and either
+    a list of key/values (if the command returned a JSON map) or the
+    output directly if not formatted as JSON
+    '''
+    try:
+        out = json.loads(out)
+    except ValueError:
+        return ['%s %s' % (o, out.rstrip('\n'))]
+    if not isinstance(out, dict):
+        return ['%s %s' % (o, json.dumps(out))]
+    items = ['%s: %s' % (k, v) for k, v in out.iteritems()] or ['']
+    return ['%s %s' % (o, items[0])] + items[1:]
+
+
+def do_daemon_command(host, osdlist, cmd, timeout=TIMEOUT):
     '''
     Do a 'ceph osd daemon' command on host for each osd in osdlist
     'cmd' is the command to execute (less the ceph osd daemon <osd.n>)
     If 'host' contains an '@', it will be split into user and host
+    Give up on the host if it takes more than 'timeout' seconds.
 
-    Prints one line per osd including name as given and either
-    a list of key/values (if the command returns a JSON map) or the
-    output of the command directly if not formatted as JSON    
+    Return (output, errors), lists of lines: output is
+    _format_output() of each osd
     '''
+    output = list()
+    errors = list()
+    deadline = time.time() + timeout
 
-    client = paramiko.SSHClient()
-    client.load_system_host_keys()
-    client.load_host_keys(os.path.expanduser('~/.ssh/known_hosts'))
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client, error = _connect(host, timeout)
+    if client is None:
+        return output, [error]
 
-    user, host = host.split('@')
-    if not host:
-        host = user
-        user = None
     try:
-        client.connect(host, username=user, timeout=15)
-    except paramiko.SSHException:
-        print >> sys.stderr, "Can't connect to ", host
-        return
-    except socket.error, v:
-        print >> sys.stderr, "Can't connect to ", host, ": ", v
-        return
+        for o in sorted(osdlist):
+            if time.time() >= deadline:
+                errors.append('%s: timed out after %ds' % (host, timeout))
+                break
+            try:
+                command = ('sudo ceph daemon {osd} {cmd}'.format(osd=o, cmd=cmd))
+                rc, out, err = _run_command(client, command, deadline)
+            except paramiko.SSHException:
+                errors.append('SSH error contacting %s' % host)
+                break
+            if rc is None:
+                errors.append('%s: timed out after %ds' % (host, timeout))
+                break
+            if rc != 0:
+                errors.append('Error: %s' % rc)
+                errors.append(err)
+                break
+            output.extend(_format_output(o, out))
+    finally:
+        _disconnect(host, client)
+    return output, errors
 
-    for o in sorted(osdlist):
-        try:
-            command = ('sudo ceph daemon {osd} {cmd}'.format(osd=o, cmd=cmd))
-            # print command
-
-            _, out, err = client.exec_command(command)
-        except paramiko.SSHException:
-            print >> sys.stderr, "SSH error contacting ", host
-            return
-        rc = out.channel.recv_exit_status()
-        if rc != 0:
-            print >> sys.stderr, "Error: ", rc
-            print >> sys.stderr, err.read()
-            return
-
-        out = out.read()
-        print o,
+
+# Run on the OSD host by do_batched_daemon_command(), as
+# 'python3 - OSD... -- COMMAND WORDS...' with this on stdin: runs the
+# command for each osd in turn, through the admin socket in-process if
+# ceph's python bindings are there (else with 'ceph daemon'), and
+# writes one JSON object per osd per line: {osd, rc, out, err}.
+REMOTE_SCRIPT = r'''
+import json
+import subprocess
+import sys
+
+try:
+    from ceph_daemon import admin_socket
+except ImportError:
+    admin_socket = None
+
+ASOK = '/var/run/ceph/ceph-{0}.asok'
+
+
+def text(s):
+    return s.decode('utf-8', 'replace') if isinstance(s, bytes) else s
+
+
+def run(osd, words):
+    if admin_socket is not None:
         try:
-            out = json.loads(out)
-            for k, v in out.iteritems():
-                print "%s: %s" % (k, v)
-        except ValueError:
-            print out
+            return 0, text(admin_socket(ASOK.format(osd), words, 'json')), ''
+        except Exception as e:
+            return 1, '', str(e)
+    p = subprocess.Popen(['ceph', 'daemon', osd] + words,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    return p.returncode, text(out), text(err)
+
+
+sep = sys.argv.index('--')
+osds, words = sys.argv[1:sep], sys.argv[sep + 1:]
+for osd in osds:
+    rc, out, err = run(osd, words)
+    sys.stdout.write(json.dumps(dict(osd=osd, rc=rc, out=out, err=err)) + '\n')
+    sys.stdout.flush()
+'''
+
+
+def do_batched_daemon_command(host, osdlist, cmd, timeout=TIMEOUT):
+    '''
+    Like do_daemon_command(), but with one ssh channel and one remote
+    process (REMOTE_SCRIPT) doing all of host's osds, instead of a
+    channel and a sudo/ceph process per osd.  An osd whose command
+    fails is reported in errors and the rest carry on.
+    '''
+    output = list()
+    errors = list()
+    deadline = time.time() + timeout
+
+    client, error = _connect(host, timeout)
+    if client is None:
+        return output, [error]
+
+    osds = sorted(osdlist)
+    command = 'sudo python3 - %s -- %s' % (
+        ' '.join(pipes.quote(o) for o in osds),
+        ' '.join(pipes.quote(w) for w in shlex.split(cmd)))
+    try:
+        rc, out, err = _run_command(client, command, deadline, REMOTE_SCRIPT)
+        done = set()
+        for line in out.splitlines(True):
+            if rc is None and not line.endswith('\n'):
+                # cut off by the timeout
+                break
+            try:
+                result = json.loads(line)
+            except ValueError:
+                errors.append('%s: bad result line %r' % (host, line))
+                continue
+            done.add(result['osd'])
+            if result['rc'] != 0:
+                errors.append('%s: error %s' % (result['osd'], result['rc']))
+                errors.append(result['err'])
+            else:
+                output.extend(_format_output(result['osd'], result['out']))
+        if len(done) < len(osds):
+            if rc is None:
+                errors.append('%s: timed out after %ds' % (host, timeout))
+            else:
+                errors.append('%s: no result for %s' % (
+                    host, ', '.join(o for o in osds if o not in done)))
+                errors.append(err)
+    except socket.timeout:
+        errors.append('%s: timed out after %ds' % (host, timeout))
+    except paramiko.SSHException:
+        errors.append('SSH error contacting %s' % host)
+    finally:
+        _disconnect(host, client)
+    return output, errors
+
+
+def run_on_hosts(host_to_osds, cmd, user=None, concurrency=CONCURRENCY,
+                 timeout=TIMEOUT, batched=False):
+    '''
+    do_daemon_command() (or with batched, do_batched_daemon_command())
+    on every host in host_to_osds, up to 'concurrency' hosts at a
+    time.  Yield (host, output, errors) in order of host name, each as
+    soon as it and the ones before it are done.
+    '''
+    command = do_batched_daemon_command if batched else do_daemon_command
+
+    def _run(host):
+        target = user + '@' + host if user else host
+        return (host,) + command(target, host_to_osds[host], cmd, timeout)
+
+    hosts = sorted(host_to_osds)
+    pool = ThreadPool(max(1, min(concurrency, len(hosts))))
+    try:
+        for result in pool.imap(_run, hosts):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
 
 
 def get_osd_tree(conf):
@@ -85,25 +266,14 @@ def get_osd_tree(conf):
 
 def get_host_and_osd_list(nodes):
     '''
-    Parse JSON containing the output of osd dump's 'nodes' item:
-    An array of crush nodes, 'id', 'type' 'osd' or 'host'
-    If type is 'host', 'children' are child ids of osds
-    
+    Parse JSON containing the output of osd tree's 'nodes' item:
+    An array of crush nodes, 'id', 'type' 'osd', 'host' or any other
+    bucket type, with 'children' the ids of the nodes in a bucket;
+    see crushtree.CrushTree
+
     Return a dict of osds[host] = [osd.n, osd.m, ..]
     '''
-    host_to_osds = dict()
-    for n in nodes:
-        if n['type'] == 'host':
-            # accumulate the ids first
-            host_to_osds[n['name']] = list(n['children'])
-        elif n['type'] == 'osd':
-            # find id in hosts_to_osds osdlists, reset id to name
-            for host, osdlist in host_to_osds.iteritems():
-                if n['id'] in osdlist:
-                    ind = host_to_osds[host].index(n['id'])
-                    host_to_osds[host][ind] = n['name']
-
-    return host_to_osds
+    return crushtree.CrushTree(nodes).host_to_osds()
 
 
 docstr = '''
@@ -111,12 +281,16 @@ Execute a Ceph osd daemon command on every OSD in a cluster with
 one connection to each OSD host.
 
 Usage:
-    osd_daemon_cmd [-c CONF] [-u USER] [-f FILE] (COMMAND | -k KEY)
+    osd_daemon_cmd [-c CONF] [-u USER] [-f FILE] [-j JOBS] [-t SECS] [-b] (COMMAND | -k KEY)
 
 Options:
    -c CONF   ceph.conf file to use [default: ./ceph.conf]
    -u USER   user to connect with ssh
    -f FILE   get names and osds from yaml
+   -j JOBS   number of hosts to work on at once [default: 16]
+   -t SECS   give up on a host after SECS seconds [default: 60]
+   -b        run each host's osds in one remote python3 process,
+             through the admin sockets if possible
    COMMAND   command other than "config get" to execute
    -k KEY    config key to retrieve with config get <key>
 
@@ -141,11 +315,14 @@ def main():
     else:
         command = args['COMMAND']
 
-    for host, osdlist in host_to_osds.iteritems():
+    results = run_on_hosts(host_to_osds, command, args['-u'],
+                           int(args['-j']), float(args['-t']), args['-b'])
+    for host, output, errors in results:
         print "%s:" % host
-        if args['-u']:
-            host = args['-u'] + '@' + host
-        do_daemon_command(host, osdlist, command)
+        for line in output:
+            print line
+        for line in errors:
+            print >> sys.stderr, line
 
 
 if __name__ == '__main__':
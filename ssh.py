@@ -1,55 +1,323 @@
 #!/usr/bin/env python
 
-import os
+import argparse
+import itertools
+import json
 import logging
 import paramiko
+import re
+import select
 import socket
+import subprocess
 import sys
+import threading
 import time
 
+from collections import OrderedDict, defaultdict
+from multiprocessing.pool import ThreadPool
+
+import crushtree
+import sshpool
+
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
+RECV_SIZE = 32768
+# hosts to run on at once
+CONCURRENCY = 16
 
-def ssh_cmd(host, cmd):
+_print_lock = threading.Lock()
 
-    client = paramiko.SSHClient()
-    client.load_system_host_keys()
-    client.load_host_keys(os.path.expanduser('~/.ssh/known_hosts'))
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
-    try:
-        user, host = host.split('@')
-    except ValueError:
-        user = None
+def print_line(host, line, stream=None):
+    '''
+    Write one line of host's output to stream (by default, stdout),
+    prefixed with host
+    '''
+    stream = stream or sys.stdout
+    with _print_lock:
+        stream.write('%s: %s\n' % (host, line))
+        stream.flush()
+
+
+def print_err_line(host, line):
+    print_line(host, line, sys.stderr)
+
+
+class _LineSplitter(object):
+    ''' Feed it data as it comes; it calls func(host, line) per line '''
+
+    def __init__(self, host, func):
+        self.host = host
+        self.func = func
+        self.partial = b''
+
+    def feed(self, data):
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.func(self.host, line.decode('utf-8', 'replace'))
+
+    def flush(self):
+        if self.partial:
+            self.func(self.host, self.partial.decode('utf-8', 'replace'))
+            self.partial = b''
 
+
+def read_output(channel, out, err, timeout=None):
+    '''
+    Pass each chunk of the stdout and stderr of the command running on
+    channel to out(data) or err(data) as soon as it arrives, waking up
+    only when there's something to read.  Return the command's exit
+    status as soon as it exits, or None (and close the channel) if
+    it's still running after timeout seconds.
+    '''
+    streams = (
+        (channel.recv_ready, channel.recv, out),
+        (channel.recv_stderr_ready, channel.recv_stderr, err),
+    )
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        for ready, recv, func in streams:
+            while ready():
+                func(recv(RECV_SIZE))
+        if channel.exit_status_ready() and \
+                (channel.eof_received or channel.closed) and \
+                not channel.recv_ready() and \
+                not channel.recv_stderr_ready():
+            break
+        wait = None
+        if deadline is not None:
+            wait = deadline - time.time()
+            if wait <= 0:
+                channel.close()
+                return None
+        if channel.eof_received:
+            # no more output is coming, and the closed buffers leave
+            # fileno() readable for good: just wait for the exit status
+            channel.status_event.wait(wait)
+        else:
+            # the channel's fileno() is readable when there's stdout or
+            # stderr data, or it's closed
+            select.select([channel], [], [], wait)
+    return channel.recv_exit_status()
+
+
+def stream_output(channel, host, out=print_line, err=print_err_line,
+                  timeout=None):
+    '''
+    read_output(), passing each line to out(host, line) or
+    err(host, line) instead
+    '''
+    splitters = (_LineSplitter(host, out), _LineSplitter(host, err))
+    rc = read_output(channel, splitters[0].feed, splitters[1].feed, timeout)
+    if rc is not None:
+        for splitter in splitters:
+            splitter.flush()
+    return rc
+
+
+def ssh_cmd(host, cmd, pool=None, timeout=None, out=print_line,
+            err=print_err_line):
+    '''
+    Run cmd on host ('user@host' or 'host') over a connection from
+    pool (by default, the shared sshpool.default_pool()), streaming
+    its output through out and err (see stream_output()).  Return its
+    exit status, or None if it couldn't be run or timed out.
+    '''
+    if pool is None:
+        pool = sshpool.default_pool()
     try:
-        client.connect(host, username=user, timeout=15)
+        client = pool.acquire(host)
     except paramiko.SSHException:
         log.error("Can't connect to %s", host)
-        return
+        return None
     except socket.error as v:
         log.error("Can't connect to %s: %s", host, v)
-        return
+        return None
 
     try:
-        _, out, err = client.exec_command(cmd)
+        return _run(client, host, cmd, timeout, out, err)
+    finally:
+        pool.release(host, client)
+
+
+def _run(client, host, cmd, timeout, out, err):
+    try:
+        channel = client.get_transport().open_session()
+        channel.exec_command(cmd)
     except paramiko.SSHException:
         log.exception("Paramiko SSH error contacting %s", host)
-        return
-    start = time.time()
-    while not out.channel.exit_status_ready():
-        log.info('waiting for exit, elapsed: %4.2f', time.time() - start)
-        time.sleep(0.5)
-    rc = out.channel.recv_exit_status()
-    if rc != 0:
-        log.error("return code: %s", rc)
-        log.error("stderr: %s", err.read())
-        return
-
-    out = out.read()
-    log.info(out)
+        return None
+    rc = stream_output(channel, host, out, err, timeout)
+    if rc is None:
+        log.error("%s: timed out after %ss", host, timeout)
+    elif rc != 0:
+        log.error("%s: return code: %s", host, rc)
+    return rc
+
+
+def expand_hosts(pattern):
+    '''
+    Expand a pdsh-style host pattern: each [m-n] (zero-padded like m)
+    or [a,b,c-d] range and {x,y} alternative multiplies out, so
+    'mira0[08-10]{a,b}' is mira008a mira008b ... mira010b
+    '''
+    parts = re.split(r'(\[[^]]*\]|\{[^}]*\})', pattern)
+    choices = list()
+    for part in parts:
+        if part.startswith('{'):
+            choices.append(part[1:-1].split(','))
+        elif part.startswith('['):
+            values = list()
+            for item in part[1:-1].split(','):
+                first, _, last = item.partition('-')
+                if not last:
+                    values.append(first)
+                    continue
+                for n in range(int(first), int(last) + 1):
+                    values.append(str(n).zfill(len(first)))
+            choices.append(values)
+        else:
+            choices.append([part])
+    return [''.join(p) for p in itertools.product(*choices)]
+
+
+def read_hosts(f):
+    ''' Return the hosts in file f, one per line, skipping #-comments '''
+    hosts = list()
+    for line in f:
+        line = line.split('#')[0].strip()
+        if line:
+            hosts.append(line)
+    return hosts
+
+
+def osd_hosts(conf):
+    ''' Return the OSD hosts of the cluster of ceph.conf 'conf' '''
+    try:
+        p = subprocess.Popen(['ceph', '-c', conf, 'osd', 'tree', '-f', 'json'],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as v:
+        log.error("Can't run ceph: %s", v)
+        return []
+    out, err = p.communicate()
+    if p.returncode != 0:
+        log.error('ceph osd tree: error %d: %s', p.returncode,
+                  err.decode('utf-8', 'replace').strip())
+        return []
+    nodes = json.loads(out.decode('utf-8')).get('nodes', [])
+    return sorted(crushtree.CrushTree(nodes).host_to_osds())
+
+
+def run_on_hosts(hosts, cmd, concurrency=CONCURRENCY, timeout=None,
+                 group=False, pool=None):
+    '''
+    ssh_cmd() on each of hosts, up to 'concurrency' at a time, each
+    given timeout seconds.  Unless group, output is streamed as it
+    arrives, prefixed with the host; with group, it's collected.
+    Return {host: (exit status or None, list of output lines)}
+    (lines only when grouping).
+    '''
+    def _run(host):
+        lines = list()
+        if group:
+            collect = lambda host, line: lines.append(line)
+            rc = ssh_cmd(host, cmd, pool, timeout, collect, collect)
+        else:
+            rc = ssh_cmd(host, cmd, pool, timeout)
+        return host, rc, lines
+
+    results = dict()
+    workers = ThreadPool(max(1, min(concurrency, len(hosts))))
+    try:
+        for host, rc, lines in workers.imap_unordered(_run, hosts):
+            results[host] = (rc, lines)
+    finally:
+        workers.close()
+        workers.join()
+    return results
+
+
+def print_grouped(results):
+    ''' Print each distinct output once, headed by the hosts that gave it '''
+    by_output = defaultdict(list)
+    for host, (rc, lines) in results.items():
+        by_output[tuple(lines)].append(host)
+    for lines, hosts in sorted(by_output.items(),
+                               key=lambda item: (-len(item[1]), item[1])):
+        print('==== %s (%d) ====' % (', '.join(sorted(hosts)), len(hosts)))
+        for line in lines:
+            print(line)
+
+
+def print_summary(results):
+    ''' Print the hosts for each exit status; return how many didn't exit 0 '''
+    by_rc = defaultdict(list)
+    for host, (rc, lines) in results.items():
+        by_rc[rc].append(host)
+    for rc in sorted(by_rc, key=lambda rc: (rc is None, rc)):
+        hosts = sorted(by_rc[rc])
+        print('%s: %d host%s: %s' % (
+            'failed' if rc is None else 'exit %d' % rc, len(hosts),
+            '' if len(hosts) == 1 else 's', ' '.join(hosts)))
+    return len(results) - len(by_rc.get(0, []))
+
+
+def parse_args():
+    ap = argparse.ArgumentParser(
+        description='Run a command on one host, or on many at once',
+        usage='%(prog)s [options] (HOST | -f FILE | -p PATTERN | -o CONF) COMMAND...')
+    ap.add_argument('-f', '--file', type=argparse.FileType('r'),
+                    action='append', default=[],
+                    help='run on the hosts in FILE, one per line (- for stdin)')
+    ap.add_argument('-p', '--pattern', action='append', default=[],
+                    help='run on the hosts a pattern like host[01-20] expands to')
+    ap.add_argument('-o', '--osd-hosts', metavar='CONF',
+                    help="run on the OSD hosts of ceph.conf CONF's cluster")
+    ap.add_argument('-u', '--user', help='user to connect as')
+    ap.add_argument('-j', '--concurrency', type=int, default=CONCURRENCY,
+                    help='hosts to run on at once (default %(default)s)')
+    ap.add_argument('-t', '--timeout', type=float,
+                    help='give up on a host after TIMEOUT seconds')
+    ap.add_argument('-g', '--group', action='store_true',
+                    help='collect output, and show identical outputs once')
+    ap.add_argument('command', nargs=argparse.REMAINDER)
+    return ap.parse_args()
+
+
+def main():
+    args = parse_args()
+    hosts = list()
+    for f in args.file:
+        hosts.extend(read_hosts(f))
+    for pattern in args.pattern:
+        hosts.extend(expand_hosts(pattern))
+    if args.osd_hosts:
+        hosts.extend(osd_hosts(args.osd_hosts))
+    command = args.command
+    if not hosts and command:
+        hosts, command = command[:1], command[1:]
+    if not hosts or not command:
+        log.error('need hosts and a command')
+        return 2
+    # keep the first of any duplicates
+    hosts = list(OrderedDict.fromkeys(hosts))
+    if args.user:
+        hosts = [h if '@' in h else args.user + '@' + h for h in hosts]
+
+    command = ' '.join(command)
+    if len(hosts) == 1 and not args.group:
+        rc = ssh_cmd(hosts[0], command, timeout=args.timeout)
+        return 1 if rc is None else rc
+
+    results = run_on_hosts(hosts, command, args.concurrency, args.timeout,
+                           args.group)
+    if args.group:
+        print_grouped(results)
+    return 1 if print_summary(results) else 0
+
 
 if __name__ == '__main__':
-    ssh_cmd(sys.argv[1], ' '.join(sys.argv[2:]))
+    sys.exit(main())
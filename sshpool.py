@@ -0,0 +1,201 @@
+'''
+sshpool.py: shared pool of open ssh connections
+
+Setting up an ssh connection (reading known_hosts, key exchange,
+authentication) costs far more than running a command over one that's
+already open, and paramiko can run any number of commands, even at
+once from several threads, over a single transport.  SSHPool keeps one
+connected paramiko.SSHClient per user@host and hands it out again for
+the next command to that host:
+
+    with sshpool.default_pool().connection('user@host') as client:
+        client.exec_command(...)
+
+Known host keys are read from disk once per pool.  Open transports
+send keepalives every KEEPALIVE seconds so idle firewalls don't drop
+them.  Connections unused for IDLE_TIMEOUT seconds are closed, and
+if more than MAX_CONNECTIONS are open, the least recently used idle
+ones go.  A connection that has died is replaced the next time it's
+asked for.
+'''
+import contextlib
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+import paramiko
+
+log = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = 15
+# seconds between keepalive packets on open transports
+KEEPALIVE = 30
+# seconds an unused connection is kept open
+IDLE_TIMEOUT = 300
+MAX_CONNECTIONS = 64
+
+
+def split_host(host):
+    ''' Return (user or None, hostname) for 'user@hostname' or 'hostname' '''
+    try:
+        user, host = host.split('@')
+    except ValueError:
+        user = None
+    return user, host
+
+
+class _Connection(object):
+
+    def __init__(self, client):
+        self.client = client
+        self.refs = 0
+        self.used = time.time()
+
+    def alive(self):
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+
+class SSHPool(object):
+    '''
+    Connected paramiko SSHClients, one per user@host, for reuse.
+    Safe to share between threads.
+    '''
+
+    def __init__(self, max_connections=MAX_CONNECTIONS,
+                 idle_timeout=IDLE_TIMEOUT, keepalive=KEEPALIVE,
+                 connect_timeout=CONNECT_TIMEOUT):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self._lock = threading.Lock()
+        # 'user@host': _Connection, least recently used first
+        self._connections = OrderedDict()
+        # 'user@host': Lock held while connecting to it
+        self._connecting = dict()
+        self._host_keys = None
+
+    def _known_host_keys(self, hostname):
+        with self._lock:
+            if self._host_keys is None:
+                self._host_keys = paramiko.HostKeys()
+                for path in ('/etc/ssh/ssh_known_hosts', '~/.ssh/known_hosts'):
+                    try:
+                        self._host_keys.load(os.path.expanduser(path))
+                    except IOError:
+                        pass
+            return self._host_keys.lookup(hostname)
+
+    def _connect(self, host, timeout):
+        user, hostname = split_host(host)
+        client = paramiko.SSHClient()
+        keys = self._known_host_keys(hostname)
+        if keys:
+            for keytype, key in keys.items():
+                client.get_host_keys().add(hostname, keytype, key)
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(hostname, username=user, timeout=timeout)
+        client.get_transport().set_keepalive(self.keepalive)
+        log.debug('sshpool: connected to %s', host)
+        return client
+
+    def _evict(self):
+        ''' Close idle connections that are too old or over the limit '''
+        now = time.time()
+        idle = [(host, conn) for host, conn in self._connections.items()
+                if conn.refs == 0]
+        excess = len(self._connections) - self.max_connections
+        for host, conn in idle:
+            if excess > 0 or now - conn.used > self.idle_timeout:
+                log.debug('sshpool: closing idle connection to %s', host)
+                del self._connections[host]
+                conn.client.close()
+                excess -= 1
+
+    def _reuse(self, host):
+        ''' With the lock held, take a reference to host's live connection '''
+        conn = self._connections.get(host)
+        if conn is None or not conn.alive():
+            return None
+        conn.refs += 1
+        conn.used = time.time()
+        self._connections.pop(host)
+        self._connections[host] = conn
+        return conn.client
+
+    def acquire(self, host, timeout=None):
+        '''
+        Return a connected SSHClient for 'user@host' (or 'host'),
+        reusing an open one if there is one.  Raises what
+        SSHClient.connect() does if it can't connect.  Give it back
+        with release() when done.
+        '''
+        with self._lock:
+            client = self._reuse(host)
+            if client is not None:
+                return client
+            connecting = self._connecting.setdefault(host, threading.Lock())
+
+        # one thread connects to a host at a time; the rest wait for it
+        # and then use its connection
+        with connecting:
+            with self._lock:
+                client = self._reuse(host)
+                if client is not None:
+                    return client
+            client = self._connect(
+                host, self.connect_timeout if timeout is None else timeout)
+            with self._lock:
+                old = self._connections.pop(host, None)
+                if old is not None:
+                    old.client.close()
+                conn = _Connection(client)
+                conn.refs += 1
+                self._connections[host] = conn
+                self._evict()
+                return client
+
+    def release(self, host, client):
+        ''' Give back a client returned by acquire(host) '''
+        with self._lock:
+            conn = self._connections.get(host)
+            if conn is None or conn.client is not client:
+                # replaced (or evicted) since; nobody else will use it
+                client.close()
+                return
+            conn.refs -= 1
+            conn.used = time.time()
+            self._evict()
+
+    @contextlib.contextmanager
+    def connection(self, host, timeout=None):
+        ''' acquire() as a context manager '''
+        client = self.acquire(host, timeout)
+        try:
+            yield client
+        finally:
+            self.release(host, client)
+
+    def close(self):
+        ''' Close every connection '''
+        with self._lock:
+            for conn in self._connections.values():
+                conn.client.close()
+            self._connections.clear()
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def default_pool():
+    ''' Return the process-wide SSHPool '''
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = SSHPool()
+        return _default_pool